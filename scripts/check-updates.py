@@ -5,15 +5,30 @@ Checks for newer versions of pinned Docker images and logs results to stdout.
 Logs are collected by Promtail → Loki → Grafana for monitoring.
 """
 
+import bisect
+import hashlib
 import json
+import os
 import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
+import urllib.parse
 import urllib.request
 import urllib.error
 
+import job_metrics
+
+try:
+    import yaml
+except ImportError:
+    # PyYAML is optional - without it compose files are scanned line by line
+    yaml = None
+
 # ANSI color codes for terminal output
 class Colors:
     GREEN = '\033[92m'
@@ -23,6 +38,179 @@ class Colors:
     RESET = '\033[0m'
     BOLD = '\033[1m'
 
+class RegistryLimiter:
+    """Caps concurrent requests and request rate for one registry"""
+
+    def __init__(self, concurrency: int, per_second: float):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        # Reserve the next free slot, then wait for it outside the lock
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+
+# Images are looked up concurrently; each registry has its own concurrency and
+# rate limit so anonymous pull limits (Docker Hub especially) are respected
+MAX_WORKERS = int(os.getenv("CHECK_UPDATES_WORKERS", "8"))
+REGISTRY_LIMITS = {
+    "https://registry.hub.docker.com": RegistryLimiter(
+        int(os.getenv("DOCKERHUB_CONCURRENCY", "3")), float(os.getenv("DOCKERHUB_REQUESTS_PER_SECOND", "5"))),
+    "https://ghcr.io": RegistryLimiter(
+        int(os.getenv("GHCR_CONCURRENCY", "4")), float(os.getenv("GHCR_REQUESTS_PER_SECOND", "5"))),
+    "https://lscr.io": RegistryLimiter(
+        int(os.getenv("LSCR_CONCURRENCY", "4")), float(os.getenv("LSCR_REQUESTS_PER_SECOND", "5"))),
+}
+
+# Lines logged by a lookup worker are held here and printed with that image's
+# results, so concurrent lookups never interleave in the output
+log_buffer = threading.local()
+
+def emit(line: str):
+    """Print a log line, or buffer it while running inside a lookup worker"""
+    lines = getattr(log_buffer, "lines", None)
+    if lines is not None:
+        lines.append(line)
+    else:
+        print(line, flush=True)
+
+# Registry bearer tokens (until they expire) and tag lists (revalidated with
+# If-None-Match once older than TAG_CACHE_TTL seconds) are kept on disk
+CACHE_FILE = os.getenv("CHECK_UPDATES_CACHE_FILE", "/tmp/check-updates-cache.json")
+TAG_CACHE_TTL = int(os.getenv("CHECK_UPDATES_TAG_TTL", "3600"))
+
+# Tags are listed in pages of this size (OCI ?n=), following the Link header
+TAGS_PAGE_SIZE = int(os.getenv("CHECK_UPDATES_TAGS_PAGE_SIZE", "1000"))
+
+# LinuxServer.io build number in tags like 4.0.1-ls123
+LS_PATTERN = re.compile(r'-ls(\d+)')
+
+# Alpine package revision in LinuxServer tags like 5.1.4-r0-ls427
+REVISION_PATTERN = re.compile(r'-r\d+(?=-|$)')
+
+# Versioned tags: optional v, numeric version (semver, dates like 2024.01.15),
+# variant suffix (-alpine, -rc1, ubu2404) and LinuxServer build number (-ls123)
+TAG_PATTERN = re.compile(
+    r'^(?P<prefix>v?)(?P<version>\d+(?:\.\d+)*)'
+    r'(?P<suffix>(?:-?(?!ls\d+$)[A-Za-z][A-Za-z0-9.]*)?(?:-(?!ls\d+$)[A-Za-z][A-Za-z0-9.]*)*)'
+    r'(?:-ls(?P<ls>\d+))?$'
+)
+
+# "digest" compares the pinned tag's manifest digest with the tag that tracks
+# it (major-version channel or latest) via HEAD requests; "tags" only uses tag
+# lists. LinuxServer -ls images always use tag lists to report the newer build.
+UPDATE_MODE = os.getenv("CHECK_UPDATES_MODE", "digest")
+
+# Pinned versions more specific than a major version, e.g. v1.27.3-alpine
+VERSION_PATTERN = re.compile(r'^(v?)(\d+)((?:\.\d+)+)(.*)$')
+
+# Accept multi-arch indexes too, so the digest is the one a pull resolves to
+MANIFEST_ACCEPT = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+
+REGISTRY_NAMES = {
+    "https://registry.hub.docker.com": "Docker Hub",
+    "https://ghcr.io": "GHCR",
+    "https://lscr.io": "LSCR",
+}
+
+class RegistryCache:
+    """On-disk cache of registry tokens and tag lists, shared by the lookup workers"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        self.data.setdefault("tokens", {})
+        self.data.setdefault("tags", {})
+
+    def get_token(self, scope: str) -> Optional[str]:
+        with self.lock:
+            entry = self.data["tokens"].get(scope)
+        # Leave some margin so a token does not expire mid-request
+        if entry and entry["expires_at"] > time.time() + 30:
+            return entry["token"]
+        return None
+
+    def put_token(self, scope: str, token: str, expires_in: int):
+        with self.lock:
+            self.data["tokens"][scope] = {"token": token, "expires_at": time.time() + expires_in}
+
+    def get_tags(self, repository: str) -> Optional[dict]:
+        with self.lock:
+            return self.data["tags"].get(repository)
+
+    def put_tags(self, repository: str, tags: List[str], etag: Optional[str],
+                 next_url: Optional[str] = None, fetched_at: Optional[float] = None):
+        """Store the tags listed so far; next_url is where the listing continues (None if complete)"""
+        with self.lock:
+            self.data["tags"][repository] = {
+                "tags": tags, "etag": etag, "next": next_url, "fetched_at": fetched_at or time.time()
+            }
+
+    def get_compose(self, path: str) -> Optional[dict]:
+        with self.lock:
+            return self.data.setdefault("compose", {}).get(path)
+
+    def put_compose(self, path: str, entry: dict):
+        with self.lock:
+            self.data.setdefault("compose", {})[path] = entry
+
+    def prune_compose(self, paths: set):
+        """Forget compose files that are no longer part of the project"""
+        with self.lock:
+            compose = self.data.setdefault("compose", {})
+            for path in compose.keys() - paths:
+                del compose[path]
+
+    def save(self):
+        """Atomically write the cache, dropping expired tokens"""
+        now = time.time()
+        with self.lock:
+            self.data["tokens"] = {
+                scope: entry for scope, entry in self.data["tokens"].items() if entry["expires_at"] > now
+            }
+            try:
+                tmp_file = f"{self.path}.tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump(self.data, f)
+                os.replace(tmp_file, self.path)
+            except OSError as e:
+                log_json("warning", "Failed to write registry cache", path=self.path, error=str(e))
+
+cache = RegistryCache(CACHE_FILE)
+
+# Per-image update status and registry latency/errors for the Prometheus textfile collector
+metrics = job_metrics.JobMetrics("check-updates")
+
+def record_image(image: str, current_version: str, status: str, latest_version: str = ""):
+    """Per-image gauges; status is update_available, up_to_date or check_failed"""
+    metrics.set("homeserver_image_check_success", "Whether the registry could be checked for the image",
+                int(status != "check_failed"), image=image, current_version=current_version)
+    if status != "check_failed":
+        metrics.set("homeserver_image_update_available", "Whether a newer version of the pinned image exists",
+                    int(status == "update_available"), image=image, current_version=current_version,
+                    latest_version=latest_version)
+
 def log_json(level: str, message: str, **kwargs):
     """Log structured JSON for Loki ingestion"""
     log_entry = {
@@ -32,36 +220,177 @@ def log_json(level: str, message: str, **kwargs):
         "message": message,
         **kwargs
     }
-    print(json.dumps(log_entry), flush=True)
+    emit(json.dumps(log_entry))
 
 def log_human(level: str, message: str, color: str = Colors.RESET):
     """Log human-readable format"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{color}[{timestamp}] [{level.upper()}] {message}{Colors.RESET}", flush=True)
+    emit(f"{color}[{timestamp}] [{level.upper()}] {message}{Colors.RESET}")
+
+# ${VAR}, ${VAR:-default}, ${VAR-default} and $VAR; $$ is a literal $
+INTERPOLATION_PATTERN = re.compile(r'\$(?:\$|\{(\w+)(?:(:?-)([^}]*))?\}|(\w+))')
 
-def parse_compose_files(compose_dir: Path) -> Dict[str, str]:
+def load_env(project_dir: Path) -> Dict[str, str]:
+    """Variables for compose interpolation: the project's .env, overridden by the environment"""
+    env = {}
+    try:
+        with open(project_dir / ".env", "r") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#") and "=" in line:
+                    key, value = line.split("=", 1)
+                    env[key.strip()] = value.strip().strip("'\"")
+    except OSError:
+        pass
+    env.update(os.environ)
+    return env
+
+def interpolate(value: str, env: Dict[str, str]) -> Optional[str]:
+    """Resolve compose variable references; None if a variable has no value or default"""
+    unresolved = False
+
+    def resolve(match):
+        nonlocal unresolved
+        if match.group(0) == "$$":
+            return "$"
+        name = match.group(1) or match.group(4)
+        operator, default = match.group(2), match.group(3)
+        current = env.get(name)
+        if operator == ":-" and not current:
+            return default
+        if operator == "-" and current is None:
+            return default
+        if current is None:
+            unresolved = True
+            return ""
+        return current
+
+    result = INTERPOLATION_PATTERN.sub(resolve, value)
+    return None if unresolved else result
+
+def read_compose_file(path: Path) -> dict:
+    """
+    Image references and includes of one compose file, before interpolation.
+    Anchors and merge keys are resolved by the YAML parser; services that
+    build their own image are skipped.
+    Returns: {"images": [[service, image], ...], "includes": [path, ...]}
+    """
+    if yaml is None:
+        image_pattern = re.compile(r'^\s*image:\s*["\']?([^\s"\']+)')
+        with open(path, "r") as f:
+            images = [["", match.group(1)] for match in map(image_pattern.match, f) if match]
+        return {"images": images, "includes": []}
+
+    with open(path, "r") as f:
+        data = yaml.safe_load(f)
+    if not isinstance(data, dict):
+        return {"images": [], "includes": []}
+
+    images = [
+        [name, str(service["image"])]
+        for name, service in (data.get("services") or {}).items()
+        if isinstance(service, dict) and service.get("image") and not service.get("build")
+    ]
+
+    includes = []
+    for entry in data.get("include") or []:
+        paths = entry.get("path") if isinstance(entry, dict) else entry
+        includes.extend([paths] if isinstance(paths, str) else paths or [])
+
+    return {"images": images, "includes": includes}
+
+def load_compose_file(path: Path) -> dict:
     """
-    Parse all compose files and extract image specifications.
-    Returns: {image_name: current_version}
+    read_compose_file() through the cache: unchanged files (same mtime and size,
+    or failing that the same content hash) are not parsed again.
     """
-    images = {}
-    image_pattern = re.compile(r'image:\s+([^:\s]+):([^\s]+)')
+    key = str(path)
+    stat = path.stat()
+    cached = cache.get_compose(key)
+    # Entries from the line scan lack service names and includes - reparse once PyYAML is there
+    if cached and cached.get("yaml") != (yaml is not None):
+        cached = None
+    if cached and cached["mtime"] == stat.st_mtime and cached["size"] == stat.st_size:
+        return cached
+
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    if cached and cached["sha256"] == digest:
+        entry = dict(cached)
+    else:
+        entry = read_compose_file(path)
+        entry.update(sha256=digest, yaml=yaml is not None)
+    entry.update(mtime=stat.st_mtime, size=stat.st_size)
+    cache.put_compose(key, entry)
+    return entry
 
-    for compose_file in compose_dir.rglob("*.yml"):
+def compose_files(compose_dir: Path) -> Iterator[tuple[Path, dict]]:
+    """
+    Parsed compose files in include order starting from the project's
+    docker-compose.yml (nested includes too), followed by any other *.yml
+    under compose_dir.
+    """
+    seen = set()
+    # A stack popped from the end: the root file first, then the rest in name order
+    pending = sorted(compose_dir.rglob("*.yml"), reverse=True) + [compose_dir.parent / "docker-compose.yml"]
+
+    while pending:
+        path = pending.pop().resolve()
+        if path in seen or not path.is_file():
+            continue
+        seen.add(path)
         try:
-            with open(compose_file, 'r') as f:
-                for line in f:
-                    match = image_pattern.search(line)
-                    if match:
-                        image_name = match.group(1)
-                        version = match.group(2)
-                        # Skip portal (our own image)
-                        if "homeserver-portal" not in image_name:
-                            images[image_name] = version
+            entry = load_compose_file(path)
         except Exception as e:
-            log_json("warning", f"Failed to parse {compose_file.name}", error=str(e))
+            log_json("warning", f"Failed to parse {path.name}", error=str(e))
+            continue
+        yield path, entry
+        # Visit includes next, in the order they are listed
+        pending.extend(path.parent / include for include in reversed(entry["includes"]))
+
+def split_image(reference: str) -> Optional[tuple[str, str]]:
+    """Split image[:tag] into (image, tag); None for digest-pinned references"""
+    if "@" in reference:
+        return None
+    name, _, tag = reference.rpartition(":")
+    if not name or "/" in tag:
+        # No tag (the colon belonged to a registry port) - compose pulls latest
+        return (reference, "latest")
+    return (name, tag)
 
-    return images
+def parse_compose_files(compose_dir: Path) -> Dict[tuple[str, str], List[tuple[str, str]]]:
+    """
+    Build the image inventory of the compose project.
+    Files are parsed through the cache, so only changed ones are read again;
+    ${VAR} references are resolved afterwards, as they depend on the environment.
+    Returns: {(image_name, version): [(service, file), ...]} - one entry per
+    distinct image:tag, however many services use it
+    """
+    inventory: Dict[tuple[str, str], List[tuple[str, str]]] = {}
+    env = load_env(compose_dir.parent)
+
+    parsed = set()
+    for compose_file, entry in compose_files(compose_dir):
+        parsed.add(str(compose_file))
+        try:
+            relative = str(compose_file.relative_to(compose_dir.parent.resolve()))
+        except ValueError:
+            relative = str(compose_file)
+
+        for service, reference in entry["images"]:
+            resolved = interpolate(reference, env)
+            if resolved is None:
+                log_json("warning", "Unresolved variable in image", image=reference,
+                         service=service, file=relative)
+                continue
+
+            image = split_image(resolved)
+            # Skip digest-pinned images and portal (our own image)
+            if image is None or "homeserver-portal" in image[0]:
+                continue
+            inventory.setdefault(image, []).append((service, relative))
+
+    cache.prune_compose(parsed)
+    return inventory
 
 def get_registry_api_url(image: str) -> tuple[str, str, str]:
     """
@@ -89,98 +418,283 @@ def get_registry_api_url(image: str) -> tuple[str, str, str]:
 
     return ("", "", "")
 
-def get_docker_hub_token(namespace: str, image: str) -> Optional[str]:
-    """Get authentication token for Docker Hub API"""
+def registry_request(registry_url: str, req) -> dict:
+    """Fetch a registry JSON endpoint within that registry's concurrency/rate limits"""
+    url = req if isinstance(req, str) else req.full_url
+    with REGISTRY_LIMITS[registry_url], metrics.request(url):
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return json.loads(response.read())
+
+def request_token(registry_url: str, challenge: str, scope: str) -> bool:
+    """
+    Answer a 'WWW-Authenticate: Bearer realm=...,service=...,scope=...' challenge
+    with an anonymous token and cache it. Returns False if no token was issued.
+    """
+    if not challenge.lower().startswith("bearer "):
+        return False
+
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop("realm", "")
+    if not realm:
+        return False
+
+    # Token requests count against the registry's budget too
+    data = registry_request(registry_url, f"{realm}?{urllib.parse.urlencode(params)}")
+    token = data.get("token") or data.get("access_token")
+    if not token:
+        return False
+
+    cache.put_token(scope, token, int(data.get("expires_in", 60)))
+    return True
+
+def next_page_url(registry_url: str, link: Optional[str]) -> Optional[str]:
+    """Absolute URL of the rel="next" page from an OCI Link header, if any"""
+    match = re.search(r'<([^>]+)>\s*;\s*rel="?next"?', link or "")
+    return urllib.parse.urljoin(registry_url, match.group(1)) if match else None
+
+def registry_open(registry_url: str, url: str, scope: str, method: str = "GET",
+                  headers: Optional[Dict[str, str]] = None) -> tuple[bytes, object]:
+    """
+    Send a registry API request with the cached token for scope, fetching an
+    anonymous token first if the registry asks for one.
+    Returns: (body, response headers) - HTTP errors other than the auth challenge are raised
+    """
+    for attempt in range(2):
+        req = urllib.request.Request(url, headers=headers or {}, method=method)
+        token = cache.get_token(scope)
+        if token:
+            req.add_header("Authorization", f"Bearer {token}")
+
+        try:
+            # Auth challenges and unknown tags/repositories are answers, not registry errors
+            with REGISTRY_LIMITS[registry_url], metrics.request(url, expected=(401, 404)):
+                with urllib.request.urlopen(req, timeout=10) as response:
+                    return (response.read(), response.headers)
+        except urllib.error.HTTPError as e:
+            if e.code == 401 and attempt == 0 and request_token(
+                    registry_url, e.headers.get("WWW-Authenticate", ""), scope):
+                continue
+            raise
+
+def registry_fetch(registry_url: str, url: str, scope: str,
+                   etag: Optional[str] = None) -> tuple[Optional[dict], Optional[str], Optional[str]]:
+    """
+    GET a registry JSON endpoint, revalidating with etag if given.
+    Returns: (data, etag, next page URL) - data is None if the registry answered 304 Not Modified
+    """
     try:
-        token_url = f"https://auth.docker.io/token?service=registry.docker.io&scope=repository:{namespace}/{image}:pull"
-        with urllib.request.urlopen(token_url, timeout=10) as response:
-            data = json.loads(response.read())
-            return data.get("token")
-    except Exception as e:
-        log_json("debug", f"Failed to get Docker Hub token", image=f"{namespace}/{image}", error=str(e))
-        return None
+        body, headers = registry_open(registry_url, url, scope, headers={"If-None-Match": etag} if etag else None)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return (None, etag, None)
+        raise
 
-def get_available_tags_dockerhub(namespace: str, image: str) -> List[str]:
-    """Get available tags from Docker Hub"""
+    return (json.loads(body), headers.get("ETag"), next_page_url(registry_url, headers.get("Link")))
+
+def manifest_digest(registry_url: str, namespace: str, image: str, tag: str) -> Optional[str]:
+    """
+    Docker-Content-Digest of a tag's manifest, from a HEAD request
+    (a few hundred bytes; HEAD does not count towards Docker Hub pull limits).
+    Returns None if the tag does not exist.
+    """
     try:
-        token = get_docker_hub_token(namespace, image)
-        if not token:
-            return []
+        _, headers = registry_open(registry_url, f"{registry_url}/v2/{namespace}/{image}/manifests/{tag}",
+                                   f"{registry_url}/{namespace}/{image}", method="HEAD",
+                                   headers={"Accept": MANIFEST_ACCEPT})
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
 
-        url = f"https://registry.hub.docker.com/v2/{namespace}/{image}/tags/list"
-        req = urllib.request.Request(url)
-        req.add_header("Authorization", f"Bearer {token}")
+    digest = headers.get("Docker-Content-Digest")
+    if not digest:
+        raise ValueError("registry did not return Docker-Content-Digest")
+    return digest
 
-        with urllib.request.urlopen(req, timeout=10) as response:
-            data = json.loads(response.read())
-            return data.get("tags", [])
-    except Exception as e:
-        log_json("debug", f"Failed to fetch Docker Hub tags", image=f"{namespace}/{image}", error=str(e))
+def channel_tags(version: str) -> List[str]:
+    """
+    Moving tags that track a pinned version, most specific first: its
+    major-version channel (1.27.3-alpine -> 1-alpine) and, without a variant
+    suffix, latest. Tags that are already moving (alpine, 16-alpine) have none.
+    """
+    match = VERSION_PATTERN.match(version)
+    if not match:
         return []
 
-def get_available_tags_ghcr(namespace: str, image: str) -> List[str]:
-    """Get available tags from GitHub Container Registry"""
-    try:
-        # GHCR uses OCI distribution spec
-        url = f"https://ghcr.io/v2/{namespace}/{image}/tags/list"
-        req = urllib.request.Request(url)
+    prefix, major, _, suffix = match.groups()
+    return [f"{prefix}{major}{suffix}"] + ([] if suffix else ["latest"])
 
-        with urllib.request.urlopen(req, timeout=10) as response:
-            data = json.loads(response.read())
-            return data.get("tags", [])
-    except urllib.error.HTTPError as e:
-        if e.code == 401:
-            log_json("debug", "GHCR authentication required (skipping)", image=f"{namespace}/{image}")
-        else:
-            log_json("debug", f"Failed to fetch GHCR tags", image=f"{namespace}/{image}", error=str(e))
-        return []
-    except Exception as e:
-        log_json("debug", f"Failed to fetch GHCR tags", image=f"{namespace}/{image}", error=str(e))
-        return []
+def iter_tags(registry_url: str, namespace: str, image: str) -> Iterator[str]:
+    """
+    Yield an image's tags page by page, following the Link header, so callers
+    can stop as soon as they have their answer. Raises if a page cannot be fetched.
 
-def get_available_tags_lscr(namespace: str, image: str) -> List[str]:
-    """Get available tags from LinuxServer.io registry"""
-    try:
-        # LSCR also uses OCI distribution spec
-        url = f"https://lscr.io/v2/{namespace}/{image}/tags/list"
-        req = urllib.request.Request(url)
+    The tags listed so far and where the listing continues are cached: within
+    TAG_CACHE_TTL they are replayed and only unseen pages are fetched. After
+    that a single-page list is revalidated with its ETag; longer lists are
+    listed again, since an unchanged first page says nothing about the rest.
+    """
+    repository = f"{registry_url}/{namespace}/{image}"
+    cached = cache.get_tags(repository)
+
+    if cached and time.time() - cached["fetched_at"] < TAG_CACHE_TTL:
+        # A copy - the cached list may be read by another worker while this one extends it
+        tags = list(cached["tags"])
+        yield from tags
+        next_url = cached.get("next")
+        fetched_at = cached["fetched_at"]
+        etag = None
+    else:
+        tags = []
+        next_url = f"{registry_url}/v2/{namespace}/{image}/tags/list?n={TAGS_PAGE_SIZE}"
+        fetched_at = time.time()
+        single_page = cached and cached.get("etag") and not cached.get("next")
+        etag = cached["etag"] if single_page else None
+
+    while next_url:
+        data, page_etag, following = registry_fetch(registry_url, next_url, repository, etag)
+
+        if data is None:
+            # 304 - the single-page list is unchanged
+            cache.put_tags(repository, cached["tags"], etag)
+            yield from cached["tags"]
+            return
+
+        page = data.get("tags") or []
+        tags.extend(page)
+        # ETags are only kept for lists that fit in one page
+        first_and_only = len(tags) == len(page) and following is None
+        cache.put_tags(repository, tags, page_etag if first_and_only else None, following, fetched_at)
+
+        yield from page
+        next_url = following
+        etag = None
+
+def check_digest(image: str, current_version: str) -> tuple[str, bool, bool, Optional[str], bool]:
+    """
+    Compare the pinned tag's manifest digest with the first channel tag that exists.
+    A different digest means the channel has moved on to a newer build.
+    Returns: same shape as scan_tags
+    """
+    registry_url, namespace, image_name = get_registry_api_url(image)
 
-        with urllib.request.urlopen(req, timeout=10) as response:
-            data = json.loads(response.read())
-            return data.get("tags", [])
+    if not registry_url:
+        return ("", False, False, None, False)
+
+    try:
+        pinned = manifest_digest(registry_url, namespace, image_name, current_version)
+        if pinned is None:
+            return (registry_url, True, False, None, False)
+
+        for channel in channel_tags(current_version):
+            digest = manifest_digest(registry_url, namespace, image_name, channel)
+            if digest is not None:
+                return (registry_url, True, True, None if digest == pinned else channel, True)
     except Exception as e:
-        log_json("debug", f"Failed to fetch LSCR tags", image=f"{namespace}/{image}", error=str(e))
-        return []
+        log_json("debug", f"Failed to fetch {REGISTRY_NAMES[registry_url]} manifest",
+                 image=f"{namespace}/{image_name}", error=str(e))
+        return (registry_url, False, False, None, False)
+
+    # No channel to compare against - all we know is that the tag exists
+    return (registry_url, True, True, None, False)
+
+def parse_tag(tag: str) -> Optional[tuple[tuple, tuple]]:
+    """
+    Parse a tag once into (family, sort key). Tags are only comparable within a
+    family - same v prefix, number of version parts, suffix and -ls style - so
+    1.27.3-alpine is never "updated" to 1.28.0 or 1.28.0-rc1. The Alpine -rN
+    revision of -ls tags is not part of the family: those order on the version,
+    then the LinuxServer build number (5.1.4-r0-ls427 < 5.1.4-r1-ls428).
+    Returns None for tags without a version (latest, alpine, ...)
+    """
+    match = TAG_PATTERN.match(tag)
+    if not match:
+        return None
 
-def get_latest_tag(image: str, current_version: str) -> Optional[str]:
+    parts = tuple(int(part) for part in match.group("version").split("."))
+    ls = match.group("ls")
+    suffix = REVISION_PATTERN.sub("", match.group("suffix")) if ls else match.group("suffix")
+    family = (match.group("prefix"), len(parts), suffix, ls is not None)
+    return (family, parts + (int(ls) if ls else -1,))
+
+class TagIndex:
+    """Parsed tags of one repository, sorted per family so lookups are bisects"""
+
+    def __init__(self):
+        self.families: Dict[tuple, List[tuple]] = {}
+        self.unsorted = set()
+
+    def add(self, tag: str) -> Optional[tuple[tuple, tuple]]:
+        """Parse and index a tag; returns its (family, key) or None"""
+        parsed = parse_tag(tag)
+        if parsed:
+            family, key = parsed
+            self.families.setdefault(family, []).append((key, tag))
+            # Sorted once on the next lookup rather than on every insert
+            self.unsorted.add(family)
+        return parsed
+
+    def newest_after(self, tag: str) -> Optional[str]:
+        """Newest tag of the same family that sorts after tag, or None"""
+        parsed = parse_tag(tag)
+        if not parsed:
+            return None
+
+        family, key = parsed
+        entries = self.families.get(family, [])
+        if family in self.unsorted:
+            entries.sort()
+            self.unsorted.discard(family)
+
+        # Skip every entry with the same key (e.g. the pinned tag itself)
+        position = bisect.bisect_right(entries, (key, chr(0x10FFFF)))
+        return entries[-1][1] if position < len(entries) else None
+
+def scan_tags(image: str, current_version: str) -> tuple[str, bool, bool, Optional[str], bool]:
     """
-    Get the latest available tag for an image.
-    Returns None if cannot determine or if already on latest.
+    Stream an image's tags into a TagIndex and compare them with the pinned
+    version, stopping once the pinned tag and a newer tag of its family are found.
+    Returns: (registry_url, lookup succeeded, pinned tag found, newest newer tag
+    seen or None, whether newer builds could be checked for)
     """
     registry_url, namespace, image_name = get_registry_api_url(image)
 
     if not registry_url:
-        log_json("debug", "Cannot determine registry", image=image)
-        return None
+        return ("", False, False, None, False)
 
-    # Get available tags based on registry
-    if "ghcr.io" in registry_url:
-        tags = get_available_tags_ghcr(namespace, image_name)
-    elif "lscr.io" in registry_url:
-        tags = get_available_tags_lscr(namespace, image_name)
-    else:
-        tags = get_available_tags_dockerhub(namespace, image_name)
+    pinned = parse_tag(current_version)
+    index = TagIndex()
+    has_newer = False
+    found = False
+    seen = 0
 
-    if not tags:
-        return None
+    try:
+        for tag in iter_tags(registry_url, namespace, image_name):
+            seen += 1
+            parsed = index.add(tag)
+            if tag == current_version:
+                found = True
+            if pinned and parsed and parsed[0] == pinned[0] and parsed[1] > pinned[1]:
+                has_newer = True
+            if found and (pinned is None or has_newer):
+                break
+    except Exception as e:
+        log_json("debug", f"Failed to fetch {REGISTRY_NAMES[registry_url]} tags",
+                 image=f"{namespace}/{image_name}", error=str(e))
+        return (registry_url, False, False, None, False)
 
-    # Check if "latest" tag exists and is different from current
-    if "latest" in tags:
-        # For now, we can't determine the actual version of "latest" without pulling
-        # So we'll just note that a "latest" tag exists
-        return "latest"
+    newer_tag = index.newest_after(current_version) if has_newer else None
+    return (registry_url, seen > 0, found, newer_tag, pinned is not None)
 
-    return None
+def lookup_image(image: str, current_version: str) -> tuple[tuple, List[str]]:
+    """Check one image in a worker, returning the result and the lines it logged"""
+    log_buffer.lines = []
+    try:
+        if UPDATE_MODE == "digest" and not LS_PATTERN.search(current_version):
+            return (check_digest(image, current_version), log_buffer.lines)
+        return (scan_tags(image, current_version), log_buffer.lines)
+    finally:
+        log_buffer.lines = None
 
 def check_updates(compose_dir: Path, use_json: bool = True):
     """
@@ -192,47 +706,55 @@ def check_updates(compose_dir: Path, use_json: bool = True):
     else:
         log_human("info", f"{Colors.BOLD}Starting Docker Image Update Check{Colors.RESET}", Colors.BLUE)
 
-    # Parse compose files
-    images = parse_compose_files(compose_dir)
+    # Parse compose files - each distinct image:tag is looked up once
+    inventory = parse_compose_files(compose_dir)
+    images = sorted(inventory)
 
     if use_json:
         log_json("info", f"Found {len(images)} images to check")
     else:
         log_human("info", f"Found {len(images)} pinned images", Colors.BLUE)
 
+    # Look up every image concurrently (bounded per registry); results are
+    # reported below in sorted order so the logs stay deterministic
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    lookups = {
+        (image, current_version): executor.submit(lookup_image, image, current_version)
+        for image, current_version in images
+    }
+
     # Check each image
     updates_available = 0
     up_to_date = 0
     check_failed = 0
 
-    for image, current_version in sorted(images.items()):
+    for image, current_version in images:
+        used_by = [f"{service} ({path})" if service else path
+                   for service, path in inventory[(image, current_version)]]
         if use_json:
-            log_json("debug", "Checking image", image=image, current_version=current_version)
+            log_json("debug", "Checking image", image=image, current_version=current_version,
+                     services=used_by)
         else:
-            log_human("info", f"Checking: {image}:{current_version}", Colors.BLUE)
+            log_human("info", f"Checking: {image}:{current_version} - {', '.join(used_by)}", Colors.BLUE)
 
-        # For now, we'll use a simple heuristic:
-        # If we can fetch tags and "latest" exists, suggest checking it
-        registry_url, namespace, image_name = get_registry_api_url(image)
+        # Result of the worker's lookup - a manifest digest comparison
+        # (check_digest) or a tag-list scan (scan_tags), depending on the mode
+        (registry_url, listed, found, newer_tag, compared), lookup_log = lookups[(image, current_version)].result()
+        for line in lookup_log:
+            emit(line)
 
         if not registry_url:
             check_failed += 1
+            record_image(image, current_version, "check_failed")
             if use_json:
                 log_json("warning", "Cannot determine registry", image=image)
             else:
                 log_human("warning", f"  ⚠️  Cannot determine registry for {image}", Colors.YELLOW)
             continue
 
-        # Get available tags
-        if "ghcr.io" in registry_url:
-            tags = get_available_tags_ghcr(namespace, image_name)
-        elif "lscr.io" in registry_url:
-            tags = get_available_tags_lscr(namespace, image_name)
-        else:
-            tags = get_available_tags_dockerhub(namespace, image_name)
-
-        if not tags:
+        if not listed:
             check_failed += 1
+            record_image(image, current_version, "check_failed")
             if use_json:
                 log_json("warning", "Failed to fetch tags", image=image)
             else:
@@ -240,24 +762,21 @@ def check_updates(compose_dir: Path, use_json: bool = True):
             continue
 
         # Check if current version is still in available tags
-        if current_version not in tags:
+        if not found:
             updates_available += 1
+            record_image(image, current_version, "update_available")
             if use_json:
                 log_json("warning", "Version not found in registry (possibly outdated)",
                         image=image, current_version=current_version, update_available=True)
             else:
                 log_human("warning", f"  ⚠️  Version {current_version} not found in registry - may be outdated!", Colors.YELLOW)
         else:
-            # Check if there are newer-looking tags (this is heuristic)
-            # For LinuxServer images, check for higher -ls numbers
-            if "-ls" in current_version:
-                current_ls = int(re.search(r'-ls(\d+)', current_version).group(1))
-                latest_ls = max([int(re.search(r'-ls(\d+)', t).group(1))
-                               for t in tags if re.search(r'-ls(\d+)', t)], default=current_ls)
-
-                if latest_ls > current_ls:
+            # Newer builds: a newer tag of the same family (tag lists), or a
+            # moved channel digest (digest mode)
+            if compared:
+                if newer_tag:
                     updates_available += 1
-                    newer_tag = [t for t in tags if f"-ls{latest_ls}" in t][0]
+                    record_image(image, current_version, "update_available", newer_tag)
                     if use_json:
                         log_json("info", "Update available", image=image,
                                 current_version=current_version, latest_version=newer_tag,
@@ -266,6 +785,7 @@ def check_updates(compose_dir: Path, use_json: bool = True):
                         log_human("info", f"  ✨ Update available: {newer_tag}", Colors.GREEN)
                 else:
                     up_to_date += 1
+                    record_image(image, current_version, "up_to_date")
                     if use_json:
                         log_json("info", "Up to date", image=image, current_version=current_version,
                                 update_available=False)
@@ -274,12 +794,20 @@ def check_updates(compose_dir: Path, use_json: bool = True):
             else:
                 # For other images, just note that we found the version
                 up_to_date += 1
+                record_image(image, current_version, "up_to_date")
                 if use_json:
                     log_json("info", "Version found in registry", image=image,
                             current_version=current_version, update_available=False)
                 else:
                     log_human("info", f"  ✓ Version found in registry", Colors.GREEN)
 
+    executor.shutdown()
+    cache.save()
+
+    for status, count in (("update_available", updates_available), ("up_to_date", up_to_date),
+                          ("check_failed", check_failed)):
+        metrics.set("homeserver_images", "Images by update status in the last check", count, status=status)
+
     # Summary
     if use_json:
         log_json("info", "Update check complete",
@@ -320,7 +848,10 @@ def main():
             log_json("error", "Update check failed", error=str(e))
         else:
             log_human("error", f"Update check failed: {e}", Colors.RED)
+        metrics.write(success=False)
         sys.exit(1)
 
+    metrics.write()
+
 if __name__ == "__main__":
     main()
@@ -7,17 +7,80 @@ Removes items from Jellyfin database that no longer exist on disk
 import os
 import sys
 import json
+import time
+import fcntl
+import select
+import struct
+import bisect
+import ctypes
+import argparse
 import requests
-from datetime import datetime
+import job_metrics
+import snapshot_store
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
 
 # Configuration
 JELLYFIN_URL = os.getenv('JELLYFIN_URL', 'http://jellyfin:8096')
 API_KEY = os.getenv('JELLYFIN_API_KEY', '')
 
+# Incremental mode - only fetch items added/changed since the last run and
+# keep the known items in a state file. A full re-sync runs every
+# FULL_SYNC_INTERVAL seconds (and whenever the state file is missing).
+INCREMENTAL = os.getenv('JELLYFIN_INCREMENTAL', 'true').lower() == 'true'
+STATE_FILE = os.getenv('JELLYFIN_STATE_FILE', '/tmp/jellyfin-cleanup-state.json')
+FULL_SYNC_INTERVAL = int(os.getenv('JELLYFIN_FULL_SYNC_INTERVAL', '3600'))
+
+# Items are fetched in pages of this size to keep memory flat on large libraries
+PAGE_SIZE = int(os.getenv('JELLYFIN_PAGE_SIZE', '500'))
+REQUEST_TIMEOUT = int(os.getenv('JELLYFIN_REQUEST_TIMEOUT', '30'))
+
+# Container mount point for media (Jellyfin paths are rewritten to this)
+MEDIA_ROOT = '/data/media'
+
+# Directory path -> set of entry names (None = missing, False = unreadable)
+# Filled lazily so each directory is listed at most once per run
+directory_listings = {}
+
+# Watch mode - react to inotify delete/move events under MEDIA_ROOT instead of
+# polling. Events are debounced for WATCH_DEBOUNCE seconds so bulk deletes are
+# handled in one batch; a full reconcile still runs every RECONCILE_INTERVAL seconds.
+WATCH_DEBOUNCE = float(os.getenv('JELLYFIN_WATCH_DEBOUNCE', '5'))
+RECONCILE_INTERVAL = int(os.getenv('JELLYFIN_RECONCILE_INTERVAL', '3600'))
+# While any directory could not be watched (e.g. max_user_watches reached),
+# reconcile this often instead - the cadence of the cron sweep the watcher replaces
+DEGRADED_RECONCILE_INTERVAL = int(os.getenv('JELLYFIN_DEGRADED_RECONCILE_INTERVAL', '60'))
+
+# Libraries (CollectionFolders) are scanned concurrently. JELLYFIN_LIBRARIES
+# optionally limits runs to a comma-separated list of library names.
+LIBRARY_CONCURRENCY = int(os.getenv('JELLYFIN_LIBRARY_CONCURRENCY', '3'))
+LIBRARY_NAMES = [name.strip() for name in os.getenv('JELLYFIN_LIBRARIES', '').split(',') if name.strip()]
+
+# Deletes run on a bounded worker pool sharing one keep-alive session
+DELETE_CONCURRENCY = int(os.getenv('JELLYFIN_DELETE_CONCURRENCY', '4'))
+
+# Held by the watcher for its whole lifetime; cron runs skip while it is held
+LOCK_FILE = os.getenv('JELLYFIN_LOCK_FILE', '/tmp/jellyfin-cleanup.lock')
+
 # Headers for API requests (will be set after authentication)
 headers = {}
 
+# Shared HTTP session (connection reuse across all Jellyfin requests)
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max(DELETE_CONCURRENCY, LIBRARY_CONCURRENCY)))
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max(DELETE_CONCURRENCY, LIBRARY_CONCURRENCY)))
+
+# Run outcome, item counts and Jellyfin latency/errors for the Prometheus textfile collector
+metrics = job_metrics.JobMetrics('jellyfin-cleanup')
+metrics.instrument(session)
+
+# Jellyfin user whose view is scanned (resolved once per run)
+user_id = None
+
+class JellyfinError(Exception):
+    """Raised when items cannot be fetched from Jellyfin"""
+
 def authenticate():
     """Authenticate with Jellyfin using API key"""
     global headers
@@ -28,6 +91,7 @@ def authenticate():
     # API keys are the recommended method for script/automation access.
     if API_KEY:
         headers['X-Emby-Token'] = API_KEY
+        session.headers.update(headers)
         print("✓ Using API key authentication")
         return True
 
@@ -39,35 +103,111 @@ def authenticate():
     print("  4. Set JELLYFIN_API_KEY in .env file")
     sys.exit(1)
 
+def to_local_path(file_path):
+    """Map a Jellyfin path to the container path (None if unexpected format)"""
+    # Jellyfin may use either /media/... or /data/media/... depending on config
+    # Container has media mounted at /data/media/
+    if file_path.startswith('/media/'):
+        # Convert /media/ to /data/media/ for container path
+        return os.path.normpath(file_path.replace('/media/', '/data/media/', 1))
+    if file_path.startswith('/data/media/'):
+        # Already using container path
+        return os.path.normpath(file_path)
+    return None
+
+def list_directory(directory):
+    """
+    Return the set of entry names in a directory, listing each directory once per run.
+
+    Returns None if the directory does not exist. Parents are resolved first, so a
+    deleted series folder is a single cached miss for every episode below it.
+    Returns False if the directory could not be read (caller falls back to a stat).
+    """
+    if directory in directory_listings:
+        return directory_listings[directory]
+
+    listing = None
+    parent = os.path.dirname(directory)
+
+    if directory != MEDIA_ROOT and parent.startswith(MEDIA_ROOT):
+        parent_listing = list_directory(parent)
+        if parent_listing is False:
+            listing = False
+        elif parent_listing is None or os.path.basename(directory) not in parent_listing:
+            listing = None
+        else:
+            listing = scan_directory(directory)
+    else:
+        listing = scan_directory(directory)
+
+    directory_listings[directory] = listing
+    return listing
+
+def scan_directory(directory):
+    """Read directory entry names with a single scandir call"""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    except OSError as e:
+        print(f"  WARNING: Cannot list {directory}: {e}")
+        return False
+
 def check_file_exists(file_path):
-    """Check if file exists on mounted media volume"""
+    """Check if file exists on mounted media volume (via the directory listing index)"""
     try:
-        # Check if file exists at the given path
-        # Jellyfin may use either /media/... or /data/media/... depending on config
-        # Container has media mounted at /data/media/
-
-        if file_path.startswith('/media/'):
-            # Convert /media/ to /data/media/ for container path
-            local_path = file_path.replace('/media/', '/data/media/', 1)
-        elif file_path.startswith('/data/media/'):
-            # Already using container path
-            local_path = file_path
-        else:
+        local_path = to_local_path(file_path)
+        if local_path is None:
             # Unexpected path format, log warning
             print(f"  WARNING: Unexpected path format: {file_path}")
             return True  # Assume exists to avoid accidental deletion
 
-        return os.path.exists(local_path)
+        listing = list_directory(os.path.dirname(local_path))
+        if listing is False:
+            # Directory unreadable - fall back to a direct check
+            return os.path.exists(local_path)
+        return listing is not None and os.path.basename(local_path) in listing
     except Exception as e:
         print(f"Error checking file: {e}")
         return True  # Assume exists to avoid accidental deletion
 
+def find_missing_items(items):
+    """Check (item_id, item) pairs against disk and return the missing ones"""
+    missing_items = []
+
+    # Sorting by path groups items by parent directory, so each directory
+    # listing is used while it is hot
+    for item_id, item in sorted(items, key=lambda pair: pair[1]['path']):
+        item_name = item['name']
+        item_type = item['type']
+        item_path = item['path']
+
+        # Check if file exists
+        if not check_file_exists(item_path):
+            missing_items.append({
+                'id': item_id,
+                'name': item_name,
+                'type': item_type,
+                'path': item_path,
+                'series_id': item.get('series_id'),
+                'season_id': item.get('season_id')
+            })
+
+    return missing_items
+
+def report_missing_items(missing_items):
+    """Print missing items (kept out of find_missing_items so worker threads stay quiet)"""
+    for item in missing_items:
+        print(f"  Missing: {item['name']} ({item['type']})")
+        print(f"           Path: {item['path']}")
+
 def get_all_users():
     """Get all Jellyfin users"""
     try:
-        response = requests.get(
+        response = session.get(
             f'{JELLYFIN_URL}/Users',
-            headers=headers
+            timeout=REQUEST_TIMEOUT
         )
         response.raise_for_status()
         return response.json()
@@ -75,148 +215,279 @@ def get_all_users():
         print(f"Error getting users from Jellyfin: {e}")
         return []
 
-def get_all_items():
-    """Get all movies and episodes from Jellyfin (across all users)"""
-    try:
-        # Get all users first
+def get_user_id():
+    """Resolve the Jellyfin user used for item queries (first user, cached)"""
+    global user_id
+
+    if user_id is None:
         users = get_all_users()
         if not users:
             print("No users found")
-            return []
-
-        # Use first user to get all items
+            raise JellyfinError("No users found")
         user_id = users[0]['Id']
 
+    return user_id
+
+def load_state():
+    """Load incremental scan state (watermark + known items) from disk"""
+    try:
+        with open(STATE_FILE, 'r') as f:
+            state = json.load(f)
+        if 'watermark' in state and 'last_full_sync' in state and 'items' in state:
+            return state
+        print(f"WARNING: Ignoring malformed state file {STATE_FILE}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"WARNING: Could not read state file {STATE_FILE}: {e}")
+    return None
+
+def save_state(state):
+    """Atomically write incremental scan state to disk"""
+    try:
+        tmp_file = f"{STATE_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, STATE_FILE)
+    except Exception as e:
+        # Not fatal - next run simply falls back to a full sync
+        print(f"WARNING: Could not write state file {STATE_FILE}: {e}")
+
+def needs_full_sync(state, now):
+    """Decide whether this run has to fetch the whole library"""
+    if not INCREMENTAL or state is None:
+        return True
+
+    try:
+        last_full_sync = datetime.fromisoformat(state['last_full_sync'])
+    except (TypeError, ValueError):
+        return True
+
+    return (now - last_full_sync).total_seconds() >= FULL_SYNC_INTERVAL
+
+def get_all_items(min_date_last_saved=None, page_size=None, parent_id=None):
+    """
+    Get all movies and episodes from Jellyfin (across all users), one page at a time.
+    Yields lists of items so path checks can start before the whole library is loaded.
+    If min_date_last_saved is given, only items added/changed since then are returned.
+    If parent_id is given, only items below that library are returned.
+    """
+    page_size = page_size or PAGE_SIZE
+
+    try:
         # Get all items for this user (Movies, TV Series, and Episodes)
+        # Only the fields needed for path checks are requested
         params = {
             'Recursive': 'true',
-            'IncludeItemTypes': 'Movie,Series,Episode',
-            'Fields': 'Path'
+            'IncludeItemTypes': 'Movie,Series,Season,Episode',
+            'Fields': 'Path',
+            'EnableImages': 'false',
+            'EnableUserData': 'false',
+            'Limit': page_size
         }
-
-        response = requests.get(
-            f'{JELLYFIN_URL}/Users/{user_id}/Items',
-            headers=headers,
-            params=params
-        )
-        response.raise_for_status()
-
-        data = response.json()
-        return data.get('Items', [])
-
+        if min_date_last_saved:
+            params['MinDateLastSaved'] = min_date_last_saved
+        if parent_id:
+            params['ParentId'] = parent_id
+
+        start_index = 0
+        while True:
+            params['StartIndex'] = start_index
+            response = session.get(
+                f'{JELLYFIN_URL}/Users/{user_id}/Items',
+                params=params,
+                timeout=REQUEST_TIMEOUT
+            )
+            response.raise_for_status()
+
+            data = response.json()
+            page = data.get('Items', [])
+            if not page:
+                break
+
+            yield page
+
+            start_index += len(page)
+            if start_index >= data.get('TotalRecordCount', 0):
+                break
+
+    except JellyfinError:
+        raise
     except Exception as e:
         print(f"Error getting items from Jellyfin: {e}")
-        sys.exit(1)
+        raise JellyfinError(str(e)) from e
 
 def delete_item(item_id, item_name):
-    """Delete an item from Jellyfin database"""
+    """
+    Delete an item from Jellyfin database.
+    Returns (success, detail) - detail explains failures and is printed by the caller.
+    """
     try:
-        response = requests.delete(
+        response = session.delete(
             f'{JELLYFIN_URL}/Items/{item_id}',
-            headers=headers
+            timeout=REQUEST_TIMEOUT
         )
 
         if response.status_code in [200, 204]:
-            return True
+            return True, None
+
+        if response.status_code == 404:
+            # Stale entry from the incremental state - already gone from Jellyfin
+            return True, "Item already removed from Jellyfin"
 
-        # Log the failure reason
-        print(f"      DELETE failed: HTTP {response.status_code}")
+        # Report the failure reason
+        detail = f"DELETE failed: HTTP {response.status_code}"
         if response.text:
-            print(f"      Response: {response.text[:200]}")
+            detail += f"\n      Response: {response.text[:200]}"
 
-        return False
+        return False, detail
     except Exception as e:
-        print(f"      Error deleting {item_name}: {e}")
-        return False
+        return False, f"Error deleting {item_name}: {e}"
 
 def get_libraries():
     """Get all media libraries"""
     try:
-        # Get all users first
-        users = get_all_users()
-        if not users:
-            print("No users found")
-            return []
-
-        # Use first user to get libraries
-        user_id = users[0]['Id']
-
-        response = requests.get(
-            f'{JELLYFIN_URL}/Users/{user_id}/Items',
-            headers=headers,
+        response = session.get(
+            f'{JELLYFIN_URL}/Users/{get_user_id()}/Items',
             params={
                 'Recursive': 'false',
                 'IncludeItemTypes': 'CollectionFolder'
-            }
+            },
+            timeout=REQUEST_TIMEOUT
         )
         response.raise_for_status()
 
         data = response.json()
         return data.get('Items', [])
 
+    except JellyfinError:
+        raise
     except Exception as e:
         print(f"Error getting libraries from Jellyfin: {e}")
         return []
 
-def main():
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Starting Jellyfin cleanup...")
-    print(f"Jellyfin URL: {JELLYFIN_URL}")
-
-    # Authenticate first
-    authenticate()
-
-    # Get all items
-    print("Fetching items from Jellyfin...")
-    items = get_all_items()
-    print(f"Found {len(items)} items in Jellyfin")
-
-    # Check each item
-    deleted_count = 0
-    missing_items = []
-
-    for item in items:
-        item_id = item.get('Id')
-        item_name = item.get('Name', 'Unknown')
-        item_type = item.get('Type', 'Unknown')
+def select_libraries(library_names=None):
+    """
+    Libraries to scan, optionally limited to the given names.
+    Returns [None] (one unscoped query) if libraries cannot be listed.
+    """
+    libraries = [
+        library for library in get_libraries()
+        # Collections and playlists only link to items that live in real libraries
+        if library.get('CollectionType') not in ('boxsets', 'playlists')
+    ]
+
+    if library_names:
+        wanted = {name.lower() for name in library_names}
+        libraries = [library for library in libraries if library.get('Name', '').lower() in wanted]
+        if not libraries:
+            print(f"ERROR: No Jellyfin library matches: {', '.join(library_names)}")
+            raise JellyfinError("No matching libraries")
+        return libraries
+
+    if not libraries:
+        print("WARNING: Could not list libraries, scanning everything in one query")
+        return [None]
+
+    return libraries
+
+def merge_items(known_items, page, library_id=None):
+    """Add fetched items with a path to known_items, returning (item_id, item) pairs"""
+    page_items = []
+
+    for item in page:
         item_path = item.get('Path')
 
         if not item_path:
             # Skip items without a file path (like collections, playlists, etc.)
             continue
 
-        # Check if file exists
-        if not check_file_exists(item_path):
-            missing_items.append({
-                'id': item_id,
-                'name': item_name,
-                'type': item_type,
-                'path': item_path
-            })
-            print(f"  Missing: {item_name} ({item_type})")
-            print(f"           Path: {item_path}")
+        entry = {
+            'name': item.get('Name', 'Unknown'),
+            'type': item.get('Type', 'Unknown'),
+            'path': item_path
+        }
+        # Parents let the deletion planner collapse whole Series/Seasons
+        if item.get('SeriesId'):
+            entry['series_id'] = item['SeriesId']
+        if item.get('SeasonId'):
+            entry['season_id'] = item['SeasonId']
+        if library_id:
+            entry['library_id'] = library_id
+        page_items.append((item.get('Id'), entry))
+        if known_items is not None:
+            known_items[item.get('Id')] = entry
+
+    return page_items
+
+def plan_deletions(missing_items):
+    """
+    Split missing items into (to_delete, collapsed).
+    Episodes/Seasons whose Series or Season is also missing are collapsed into
+    the parent: deleting the parent removes the whole subtree in one request.
+    """
+    missing_ids = {item['id'] for item in missing_items}
+    to_delete = []
+    collapsed = []
 
-    # Show summary and delete missing items
-    if not missing_items:
-        print("\n✓ No missing items found. Database is clean!")
-        return
+    for item in missing_items:
+        parent_ids = (item.get('series_id'), item.get('season_id'))
+        if any(parent_id in missing_ids for parent_id in parent_ids if parent_id):
+            collapsed.append(item)
+        else:
+            to_delete.append(item)
+
+    return to_delete, collapsed
 
+def report_counts(scanned, tracked, missing):
+    """Item counts of this pass; delete_missing_items() fills in the deletion stages"""
+    metrics.set_items('scanned', scanned)
+    metrics.set_items('tracked', tracked)
+    metrics.set_items('missing', missing)
+    for stage in ('deleted', 'collapsed', 'delete_failed'):
+        metrics.set_items(stage, 0)
+
+def delete_missing_items(missing_items, known_items):
+    """Delete missing items from Jellyfin and drop them from known_items"""
     print(f"\nFound {len(missing_items)} missing items.")
-    print(f"\n🗑️  Deleting missing items from Jellyfin database...")
 
-    deleted_count = 0
-    failed_count = 0
+    to_delete, collapsed = plan_deletions(missing_items)
+    if collapsed:
+        print(f"{len(collapsed)} item(s) are removed together with their missing Series/Season")
 
-    for item in missing_items:
-        item_id = item['id']
-        item_name = item['name']
-        item_type = item['type']
+    print(f"\n🗑️  Deleting {len(to_delete)} missing item(s) from Jellyfin database...")
 
-        if delete_item(item_id, item_name):
-            print(f"   ✓ Deleted: {item_name} ({item_type})")
-            deleted_count += 1
-        else:
-            print(f"   ✗ Failed to delete: {item_name} ({item_type})")
-            failed_count += 1
+    deleted_count = 0
+    failed_count = 0
+    deleted_ids = set()
+
+    with ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY) as executor:
+        results = executor.map(lambda item: delete_item(item['id'], item['name']), to_delete)
+
+        for item, (success, detail) in zip(to_delete, results):
+            item_id = item['id']
+            item_name = item['name']
+            item_type = item['type']
+
+            if detail:
+                print(f"      {detail}")
+            if success:
+                print(f"   ✓ Deleted: {item_name} ({item_type})")
+                known_items.pop(item_id, None)
+                deleted_ids.add(item_id)
+                deleted_count += 1
+            else:
+                print(f"   ✗ Failed to delete: {item_name} ({item_type})")
+                failed_count += 1
+
+    # Children went away with their deleted parent
+    for item in collapsed:
+        if item.get('series_id') in deleted_ids or item.get('season_id') in deleted_ids:
+            known_items.pop(item['id'], None)
+
+    metrics.set_items('deleted', deleted_count)
+    metrics.set_items('collapsed', len(collapsed))
+    metrics.set_items('delete_failed', failed_count)
 
     # Summary
     if deleted_count > 0:
@@ -225,6 +496,405 @@ def main():
     if failed_count > 0:
         print(f"\n⚠️  Failed to delete {failed_count} item(s)")
 
+def scan_library(library, min_date_last_saved, known_items):
+    """
+    Fetch one library page by page and check each page against disk.
+    Returns (fetched_count, fetched_ids, missing_items).
+    """
+    library_id = library['Id'] if library else None
+    fetched_count = 0
+    fetched_ids = set()
+    missing_items = []
+
+    for page in get_all_items(min_date_last_saved=min_date_last_saved, parent_id=library_id):
+        fetched_count += len(page)
+        page_items = merge_items(known_items, page, library_id)
+        fetched_ids.update(item_id for item_id, _ in page_items)
+        missing_items.extend(find_missing_items(page_items))
+
+    return fetched_count, fetched_ids, missing_items
+
+def run_sweep(libraries, partial=False, force_full=False, keep_items=INCREMENTAL):
+    """
+    Check every known item in the given libraries against disk and delete the missing ones.
+    partial means only some libraries are scanned, so the global cursor is left alone.
+    Returns the resulting state (watermark, last_full_sync, items).
+    """
+    # Start every run with fresh directory listings
+    directory_listings.clear()
+
+    # Decide between a full sync and an incremental fetch
+    now = datetime.now(timezone.utc)
+    state = load_state() if INCREMENTAL else None
+    full_sync = force_full or needs_full_sync(state, now)
+    library_ids = {library['Id'] for library in libraries if library}
+
+    # Watermark is taken before fetching so items saved mid-request are
+    # picked up again on the next run
+    watermark = now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    if full_sync:
+        print("Fetching all items from Jellyfin (full sync)...")
+        min_date_last_saved = None
+        known_items = {}
+        last_full_sync = now.isoformat()
+        if partial and state:
+            # Keep what we know about the libraries not scanned this time
+            known_items = {
+                item_id: item for item_id, item in state['items'].items()
+                if item.get('library_id') not in library_ids
+            }
+    else:
+        print(f"Fetching items changed since {state['watermark']} (incremental)...")
+        min_date_last_saved = state['watermark']
+        known_items = state['items']
+        last_full_sync = state['last_full_sync']
+
+    if partial and state:
+        # Other libraries were not fetched - keep their cursor
+        watermark = state['watermark']
+        last_full_sync = state['last_full_sync']
+    elif partial:
+        # Only some libraries are known - the next unscoped run must be a full sync
+        last_full_sync = None
+
+    # Scan libraries concurrently; each worker checks its pages as they arrive
+    # and merges them into the known set (ID -> name/type/path)
+    fetched_count = 0
+    fetched_ids = set()
+    missing_items = []
+
+    with ThreadPoolExecutor(max_workers=LIBRARY_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(scan_library, library, min_date_last_saved,
+                            known_items if keep_items else None): library
+            for library in libraries
+        }
+        for future in as_completed(futures):
+            library = futures[future]
+            library_count, library_ids_seen, library_missing = future.result()
+            if library:
+                print(f"  {library.get('Name', 'Unknown')}: {library_count} items, "
+                      f"{len(library_missing)} missing")
+            fetched_count += library_count
+            fetched_ids.update(library_ids_seen)
+            missing_items.extend(library_missing)
+
+    print(f"Found {fetched_count} items in Jellyfin")
+
+    # Incremental runs still verify everything known from earlier runs
+    if not full_sync:
+        print(f"Tracking {len(known_items)} items from state")
+        missing_items.extend(find_missing_items(
+            (item_id, item) for item_id, item in known_items.items()
+            if item_id not in fetched_ids
+            and (not partial or item.get('library_id') in library_ids)
+        ))
+
+    report_counts(fetched_count, len(known_items), len(missing_items))
+
+    # Show summary and delete missing items
+    if missing_items:
+        report_missing_items(missing_items)
+        delete_missing_items(missing_items, known_items)
+    else:
+        print("\n✓ No missing items found. Database is clean!")
+
+    state = {'watermark': watermark, 'last_full_sync': last_full_sync, 'items': known_items}
+    if INCREMENTAL:
+        save_state(state)
+    # Only a run over every library has the complete item set
+    if keep_items and not partial:
+        publish_items(known_items, now.timestamp())
+    return state
+
+def publish_items(known_items, fetched_at=None):
+    """Share the known item IDs so other jobs can skip their own Jellyfin lookups"""
+    if snapshot_store.save_snapshot(
+        'jellyfin', {item_id: item['type'] for item_id, item in known_items.items()}, fetched_at
+    ):
+        print(f"Published snapshot of {len(known_items)} items")
+
+def refresh_items(state, libraries):
+    """Merge items added/changed since the state watermark (no disk checks)"""
+    now = datetime.now(timezone.utc)
+    fetched_count = 0
+
+    for library in libraries:
+        library_id = library['Id'] if library else None
+        for page in get_all_items(min_date_last_saved=state['watermark'], parent_id=library_id):
+            fetched_count += len(page)
+            merge_items(state['items'], page, library_id)
+
+    state['watermark'] = now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    if fetched_count:
+        print(f"Merged {fetched_count} new/changed item(s) from Jellyfin")
+
+def build_path_index(known_items):
+    """Sorted (local_path, item_id) pairs for prefix lookups of removed paths"""
+    index = []
+    for item_id, item in known_items.items():
+        local_path = to_local_path(item['path'])
+        if local_path:
+            index.append((local_path, item_id))
+    index.sort()
+    return index
+
+def items_under_paths(index, paths):
+    """Item IDs whose local path is one of paths or lies below one of them"""
+    item_ids = set()
+
+    for path in paths:
+        # Exact matches, then everything below path/ - siblings such as "path (2)"
+        # sort between the two, so each range gets its own lookup
+        for prefix, matches in ((path, lambda item_path: item_path == path),
+                                (path + '/', lambda item_path: item_path.startswith(path + '/'))):
+            position = bisect.bisect_left(index, (prefix,))
+            while position < len(index) and matches(index[position][0]):
+                item_ids.add(index[position][1])
+                position += 1
+
+    return item_ids
+
+def acquire_lock():
+    """Take the cleanup lock without blocking; returns the open file or None"""
+    lock = open(LOCK_FILE, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+class InotifyWatcher:
+    """Recursive inotify watch (via libc) reporting removed paths below a root"""
+
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}  # watch descriptor -> directory path
+        self.unwatched = set()  # directories inotify_add_watch failed for
+        self.add_tree(root)
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            print(f"  WARNING: Cannot watch {directory}: {os.strerror(ctypes.get_errno())}")
+            self.unwatched.add(directory)
+            return
+        self.unwatched.discard(directory)
+        self.watches[wd] = directory
+
+    def retry_unwatched(self):
+        """Try the directories that could not be watched again; True if all are watched now"""
+        for directory in list(self.unwatched):
+            if os.path.isdir(directory):
+                self.add_watch(directory)
+            else:
+                self.unwatched.discard(directory)
+        return not self.unwatched
+
+    def add_tree(self, root):
+        """Watch a directory and every directory below it"""
+        for directory, _, _ in os.walk(root):
+            self.add_watch(directory)
+
+    def read_events(self, timeout):
+        """
+        Wait up to timeout seconds for events.
+        Returns (removed_paths, overflowed) - overflowed means events were lost.
+        """
+        removed_paths = []
+        overflowed = False
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return removed_paths, overflowed
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+
+                if mask & self.IN_Q_OVERFLOW:
+                    overflowed = True
+                    continue
+
+                directory = self.watches.get(wd)
+                if mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if directory is None:
+                    continue
+
+                path = os.path.join(directory, name) if name else directory
+                if mask & (self.IN_DELETE | self.IN_MOVED_FROM | self.IN_DELETE_SELF):
+                    removed_paths.append(path)
+                elif mask & (self.IN_CREATE | self.IN_MOVED_TO) and mask & self.IN_ISDIR:
+                    # New directories (e.g. a freshly imported series) need their own watches
+                    self.add_tree(path)
+
+        return removed_paths, overflowed
+
+def watch(library_names):
+    """Long-running mode: delete items as soon as their files disappear"""
+    global user_id
+
+    lock = acquire_lock()
+    if lock is None:
+        print(f"ERROR: Another Jellyfin cleanup holds {LOCK_FILE}")
+        sys.exit(1)
+
+    print(f"Watching {MEDIA_ROOT} (debounce {WATCH_DEBOUNCE}s, reconcile every {RECONCILE_INTERVAL}s)")
+    watcher = InotifyWatcher(MEDIA_ROOT)
+    print(f"Watching {len(watcher.watches)} directories")
+
+    state = None
+    index = []
+    libraries = []
+    next_reconcile = time.monotonic()
+    next_full_reconcile = next_reconcile
+    pending_paths = set()
+    last_event = 0.0
+
+    while True:
+        try:
+            if time.monotonic() >= next_reconcile:
+                full = time.monotonic() >= next_full_reconcile
+                fully_watched = watcher.retry_unwatched()
+                if full:
+                    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Running full reconcile...")
+                else:
+                    # Deletions under unwatched directories are only found by sweeping
+                    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] "
+                          f"{len(watcher.unwatched)} directories not watched, running sweep...")
+                metrics.start()
+                # Users and libraries may have changed since the last reconcile
+                user_id = None
+                libraries = select_libraries(library_names)
+                state = run_sweep(libraries, partial=bool(library_names), force_full=full, keep_items=True)
+                index = build_path_index(state['items'])
+                if full:
+                    next_full_reconcile = time.monotonic() + RECONCILE_INTERVAL
+                interval = RECONCILE_INTERVAL if fully_watched else DEGRADED_RECONCILE_INTERVAL
+                next_reconcile = min(next_full_reconcile, time.monotonic() + interval)
+                metrics.write()
+
+            timeout = WATCH_DEBOUNCE if pending_paths else max(next_reconcile - time.monotonic(), 0)
+            removed_paths, overflowed = watcher.read_events(timeout)
+
+            if overflowed:
+                # Events were dropped - only a full reconcile is safe now
+                print("WARNING: inotify queue overflowed, scheduling full reconcile")
+                pending_paths.clear()
+                next_reconcile = next_full_reconcile = time.monotonic()
+                continue
+
+            if watcher.unwatched:
+                # A new directory could not be watched - fall back to sweeping
+                next_reconcile = min(next_reconcile, time.monotonic() + DEGRADED_RECONCILE_INTERVAL)
+
+            if removed_paths:
+                pending_paths.update(removed_paths)
+                last_event = time.monotonic()
+                continue
+
+            if not pending_paths or time.monotonic() - last_event < WATCH_DEBOUNCE:
+                continue
+
+            # Quiet period reached - handle the whole batch at once
+            print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {len(pending_paths)} path(s) removed")
+            metrics.start()
+            refresh_items(state, libraries)
+            index = build_path_index(state['items'])
+            affected_ids = items_under_paths(index, pending_paths)
+            pending_paths.clear()
+
+            if not affected_ids:
+                continue
+
+            # Re-check on disk - files may have been replaced or moved back
+            directory_listings.clear()
+            missing_items = find_missing_items(
+                (item_id, state['items'][item_id]) for item_id in affected_ids
+            )
+            report_counts(len(affected_ids), len(state['items']), len(missing_items))
+            if missing_items:
+                report_missing_items(missing_items)
+                delete_missing_items(missing_items, state['items'])
+                index = build_path_index(state['items'])
+            if not library_names:
+                if INCREMENTAL:
+                    save_state(state)
+                publish_items(state['items'])
+            metrics.write()
+
+        except JellyfinError:
+            # Jellyfin unavailable - keep pending paths and retry later
+            metrics.write(success=False)
+            print(f"Retrying in {WATCH_DEBOUNCE}s...")
+            time.sleep(WATCH_DEBOUNCE)
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove Jellyfin items whose files no longer exist')
+    parser.add_argument('--watch', action='store_true',
+                        help='run as a daemon reacting to filesystem events')
+    parser.add_argument('--library', action='append', dest='libraries', metavar='NAME',
+                        help='only scan this library (repeatable, overrides JELLYFIN_LIBRARIES)')
+    args = parser.parse_args()
+    library_names = args.libraries or LIBRARY_NAMES
+
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Starting Jellyfin cleanup...")
+    print(f"Jellyfin URL: {JELLYFIN_URL}")
+
+    # Authenticate first
+    authenticate()
+
+    if library_names:
+        print(f"Libraries: {', '.join(library_names)}")
+
+    if args.watch:
+        watch(library_names)
+        return
+
+    # The watcher (or an overlapping cron run) already covers this
+    lock = acquire_lock()
+    if lock is None:
+        print("Another Jellyfin cleanup is running (watcher active?), skipping.")
+        return
+
+    try:
+        libraries = select_libraries(library_names)
+        run_sweep(libraries, partial=bool(library_names))
+    except JellyfinError:
+        metrics.write(success=False)
+        sys.exit(1)
+
+    metrics.write()
+
     print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Cleanup complete.")
 
 if __name__ == '__main__':
@@ -9,7 +9,10 @@ import os
 import sys
 import json
 import requests
-from datetime import datetime
+import job_metrics
+import snapshot_store
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 
 # Configuration
 JELLYSEERR_URL = os.getenv('JELLYSEERR_URL', 'http://jellyseerr:5055')
@@ -17,6 +20,20 @@ JELLYSEERR_API_KEY = os.getenv('JELLYSEERR_API_KEY', '')
 JELLYFIN_URL = os.getenv('JELLYFIN_URL', 'http://jellyfin:8096')
 JELLYFIN_API_KEY = os.getenv('JELLYFIN_API_KEY', '')
 
+# Number of Jellyfin IDs looked up per /Items?Ids=... request
+JELLYFIN_IDS_CHUNK = int(os.getenv('JELLYFIN_IDS_CHUNK', '100'))
+
+# Jellyseerr media is paged; pages after the first are fetched concurrently
+JELLYSEERR_PAGE_SIZE = int(os.getenv('JELLYSEERR_PAGE_SIZE', '100'))
+JELLYSEERR_CONCURRENCY = int(os.getenv('JELLYSEERR_CONCURRENCY', '4'))
+
+# Incremental mode - keep a snapshot of available media plus the newest updatedAt
+# seen, and only page through media modified since then. A full walk runs every
+# JELLYSEERR_FULL_SYNC_INTERVAL seconds or when media left the available set.
+JELLYSEERR_INCREMENTAL = os.getenv('JELLYSEERR_INCREMENTAL', 'true').lower() == 'true'
+JELLYSEERR_FULL_SYNC_INTERVAL = int(os.getenv('JELLYSEERR_FULL_SYNC_INTERVAL', '86400'))
+STATE_FILE = os.getenv('JELLYSEERR_CLEANUP_STATE_FILE', '/tmp/jellyseerr-cleanup-state.json')
+
 # Check if API keys are set
 if not JELLYSEERR_API_KEY:
     print("ERROR: JELLYSEERR_API_KEY environment variable not set")
@@ -37,44 +54,239 @@ jellyfin_headers = {
     'X-Emby-Token': JELLYFIN_API_KEY
 }
 
-def check_jellyfin_item_exists(jellyfin_media_id):
-    """Check if item exists in Jellyfin"""
-    if not jellyfin_media_id:
-        return False
+# Run outcome and per-upstream latency/errors for the Prometheus textfile collector
+metrics = job_metrics.JobMetrics('jellyseerr-cleanup')
+session = metrics.instrument(requests.Session())
+
+def normalize_jellyfin_id(jellyfin_media_id):
+    """Jellyfin IDs are GUIDs that may or may not contain dashes"""
+    return jellyfin_media_id.replace('-', '').lower()
+
+def load_jellyfin_snapshot():
+    """
+    Jellyfin item IDs published by a recent jellyfin-cleanup run (None if there
+    is no fresh one). IDs in it are known to exist; anything else is still
+    looked up, so a stale snapshot can never cause a deletion.
+    """
+    snapshot = snapshot_store.load_snapshot('jellyfin')
+    if snapshot is None:
+        return None
+    print(f"Using Jellyfin snapshot with {len(snapshot)} items")
+    return {normalize_jellyfin_id(item_id) for item_id in snapshot}
+
+def get_existing_jellyfin_ids(jellyfin_media_ids, known_ids=None):
+    """
+    Return the subset of Jellyfin IDs that still exist in Jellyfin.
+    IDs in known_ids are taken as existing; the rest are resolved in chunks
+    with /Items?Ids=a,b,c instead of one GET per item.
+    """
+    ids = {normalize_jellyfin_id(i) for i in jellyfin_media_ids if i}
+    existing = ids & known_ids if known_ids else set()
+    ids = sorted(ids - existing)
+
+    for start in range(0, len(ids), JELLYFIN_IDS_CHUNK):
+        chunk = ids[start:start + JELLYFIN_IDS_CHUNK]
+        try:
+            response = session.get(
+                f'{JELLYFIN_URL}/Items',
+                headers=jellyfin_headers,
+                params={
+                    'Ids': ','.join(chunk),
+                    'EnableImages': 'false',
+                    'EnableUserData': 'false',
+                    'EnableTotalRecordCount': 'false'
+                },
+                timeout=30
+            )
+            response.raise_for_status()
 
+            for item in response.json().get('Items', []):
+                existing.add(normalize_jellyfin_id(item.get('Id', '')))
+        except Exception as e:
+            print(f"    Error checking {len(chunk)} Jellyfin items: {e}")
+            existing.update(chunk)  # Assume exists to avoid accidental deletion
+
+    return existing
+
+def load_state():
+    """Load the Jellyseerr snapshot from disk (None if missing or unusable)"""
     try:
-        response = requests.get(
-            f'{JELLYFIN_URL}/Items/{jellyfin_media_id}',
-            headers=jellyfin_headers,
-            timeout=5
-        )
-        return response.status_code == 200
+        with open(STATE_FILE, 'r') as f:
+            state = json.load(f)
+        if {'updated_at', 'last_full_sync', 'media'} <= state.keys():
+            return state
+        print(f"WARNING: Ignoring malformed state file {STATE_FILE}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"WARNING: Could not read state file {STATE_FILE}: {e}")
+    return None
+
+def save_state(state):
+    """Atomically write the Jellyseerr snapshot to disk"""
+    try:
+        tmp_file = f"{STATE_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, STATE_FILE)
     except Exception as e:
-        print(f"    Error checking Jellyfin item {jellyfin_media_id}: {e}")
-        return True  # Assume exists to avoid accidental deletion
+        # Not fatal - next run simply falls back to a full sync
+        print(f"WARNING: Could not write state file {STATE_FILE}: {e}")
+
+def needs_full_sync(state, now):
+    """Decide whether this run has to walk every page"""
+    if not JELLYSEERR_INCREMENTAL or state is None:
+        return True
+
+    try:
+        last_full_sync = datetime.fromisoformat(state['last_full_sync'])
+    except (TypeError, ValueError):
+        return True
+
+    return (now - last_full_sync).total_seconds() >= JELLYSEERR_FULL_SYNC_INTERVAL
+
+def compact_media(item):
+    """Keep only the fields the cleanup needs"""
+    return {
+        'id': item.get('id'),
+        'mediaType': item.get('mediaType'),
+        'title': item.get('title'),
+        'status': item.get('status'),
+        'jellyfinMediaId': item.get('jellyfinMediaId')
+    }
+
+def get_jellyseerr_media_page(skip, sort=None):
+    """
+    Fetch one page of available media from Jellyseerr. Incremental runs pass
+    sort='modified' (most recently modified first); full walks keep the default
+    ID order, which media modified mid-walk cannot shift between pages.
+    """
+    # Status values: 1=UNKNOWN, 2=PENDING, 3=PROCESSING, 4=PARTIALLY_AVAILABLE, 5=AVAILABLE
+    # 'allavailable' filters server-side to status 4 and 5
+    params = {
+        'take': JELLYSEERR_PAGE_SIZE,
+        'skip': skip,
+        'filter': 'allavailable'
+    }
+    if sort:
+        params['sort'] = sort
+
+    response = session.get(
+        f'{JELLYSEERR_URL}/api/v1/media',
+        headers=jellyseerr_headers,
+        params=params,
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.json()
+
+def sync_jellyseerr_incremental(state):
+    """
+    Merge media modified since the snapshot into it, newest first, stopping at the
+    first already-seen record. Returns False if media left the available set
+    (deleted or status changed) and a full walk is needed.
+    """
+    media = state['media']
+    watermark = state['updated_at']
+    total = None
+    skip = 0
+
+    while True:
+        data = get_jellyseerr_media_page(skip, sort='modified')
+        results = data.get('results', [])
+        if total is None:
+            total = data.get('pageInfo', {}).get('results')
+
+        changed = [item for item in results if (item.get('updatedAt') or '') >= watermark]
+        for item in changed:
+            media[str(item['id'])] = compact_media(item)
+            state['updated_at'] = max(state['updated_at'], item.get('updatedAt') or '')
+
+        if len(changed) < len(results) or len(results) < JELLYSEERR_PAGE_SIZE:
+            break
+        skip += JELLYSEERR_PAGE_SIZE
+
+    # Everything that entered the available set was merged above, so the counts
+    # only differ when something left it
+    if total != len(media):
+        print(f"Jellyseerr has {total} available media, snapshot has {len(media)} - running full sync")
+        return False
+
+    print(f"Incremental sync: {skip // JELLYSEERR_PAGE_SIZE + 1} page(s) fetched")
+    return True
 
 def get_jellyseerr_media():
-    """Get all media from Jellyseerr"""
+    """
+    Yield all available media from Jellyseerr.
+    Incremental runs yield the updated snapshot. Full walks read pageInfo.pages
+    from the first page, fetch the rest on a bounded pool and yield results as
+    they arrive, so processing starts early.
+    """
+    now = datetime.now(timezone.utc)
+    state = load_state() if JELLYSEERR_INCREMENTAL else None
+
     try:
-        # Get all media with status 5 (AVAILABLE) or 4 (PARTIALLY_AVAILABLE)
-        # Status values: 1=UNKNOWN, 2=PENDING, 3=PROCESSING, 4=PARTIALLY_AVAILABLE, 5=AVAILABLE
-        response = requests.get(
-            f'{JELLYSEERR_URL}/api/v1/media',
-            headers=jellyseerr_headers,
-            params={'take': 1000}  # Get up to 1000 items
-        )
-        response.raise_for_status()
+        if not needs_full_sync(state, now) and sync_jellyseerr_incremental(state):
+            save_state(state)
+            yield from state['media'].values()
+            return
 
-        data = response.json()
-        return data.get('results', [])
+        data = get_jellyseerr_media_page(0)
     except Exception as e:
         print(f"Error getting media from Jellyseerr: {e}")
-        return []
+        return
+
+    state = {'updated_at': '', 'last_full_sync': now.isoformat(), 'media': {}}
+    complete = True
+
+    def collect(results):
+        for item in results:
+            state['media'][str(item['id'])] = compact_media(item)
+            state['updated_at'] = max(state['updated_at'], item.get('updatedAt') or '')
+        return results
+
+    yield from collect(data.get('results', []))
+
+    total = data.get('pageInfo', {}).get('results')
+    pages = data.get('pageInfo', {}).get('pages', 1)
+    if pages > 1:
+        with ThreadPoolExecutor(max_workers=JELLYSEERR_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(get_jellyseerr_media_page, page * JELLYSEERR_PAGE_SIZE)
+                for page in range(1, pages)
+            ]
+            for future in as_completed(futures):
+                try:
+                    yield from collect(future.result().get('results', []))
+                except Exception as e:
+                    # Skipping a page only means fewer items are checked this run
+                    print(f"Error getting media page from Jellyseerr: {e}")
+                    complete = False
+
+    # Media added or removed mid-walk can still shift pages - a walk that did not
+    # see exactly the advertised count is not a valid base either
+    if complete and total != len(state['media']):
+        print(f"Jellyseerr reports {total} available media but the walk saw {len(state['media'])}")
+        complete = False
+
+    # Only a complete walk is a valid base for later incremental runs
+    if JELLYSEERR_INCREMENTAL and complete:
+        save_state(state)
+
+def forget_jellyseerr_media(media_ids):
+    """Drop deleted media from the snapshot so the next run stays incremental"""
+    state = load_state() if JELLYSEERR_INCREMENTAL else None
+    if state is None:
+        return
+
+    for media_id in media_ids:
+        state['media'].pop(str(media_id), None)
+    save_state(state)
 
 def delete_jellyseerr_media(media_id):
     """Delete media from Jellyseerr (also deletes associated requests)"""
     try:
-        response = requests.delete(
+        response = session.delete(
             f'{JELLYSEERR_URL}/api/v1/media/{media_id}',
             headers=jellyseerr_headers
         )
@@ -83,41 +295,70 @@ def delete_jellyseerr_media(media_id):
         print(f"    Error deleting media: {e}")
         return False
 
+def find_missing_media(media_items, known_ids=None):
+    """Return Jellyseerr media whose Jellyfin item no longer exists"""
+    existing_ids = get_existing_jellyfin_ids((item['jellyfinMediaId'] for item in media_items), known_ids)
+    missing_items = []
+
+    for item in media_items:
+        jellyfin_media_id = item['jellyfinMediaId']
+        if normalize_jellyfin_id(jellyfin_media_id) in existing_ids:
+            continue
+
+        media_type = item.get('mediaType', 'unknown')
+        title = item.get('title', 'Unknown')
+        missing_items.append({
+            'id': item.get('id'),
+            'title': title,
+            'type': media_type,
+            'jellyfin_id': jellyfin_media_id
+        })
+        print(f"  Missing: {title} ({media_type})")
+        print(f"           Jellyfin ID: {jellyfin_media_id}")
+
+    return missing_items
+
 def main():
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Starting Jellyseerr cleanup...")
     print(f"Jellyseerr URL: {JELLYSEERR_URL}")
     print(f"Jellyfin URL: {JELLYFIN_URL}")
 
-    # Get all media from Jellyseerr
-    print("\nFetching media from Jellyseerr...")
-    media_items = get_jellyseerr_media()
-    print(f"Found {len(media_items)} media items in Jellyseerr")
+    # Stream media from Jellyseerr and check it against Jellyfin in chunks,
+    # so Jellyfin lookups overlap with the remaining page fetches
+    known_ids = load_jellyfin_snapshot()
 
-    # Check each media item
-    deleted_count = 0
+    print("\nFetching media from Jellyseerr...")
+    media_count = 0
+    candidate_count = 0
+    pending = []
     missing_items = []
 
-    for item in media_items:
-        media_id = item.get('id')
-        media_type = item.get('mediaType', 'unknown')
-        title = item.get('title', 'Unknown')
-        status = item.get('status')
-        jellyfin_media_id = item.get('jellyfinMediaId')
+    for item in get_jellyseerr_media():
+        media_count += 1
 
-        # Only check items that are marked as available
-        if status not in [4, 5]:  # PARTIALLY_AVAILABLE or AVAILABLE
+        # Only check items that are marked as available and linked to Jellyfin
+        if item.get('status') not in [4, 5]:  # PARTIALLY_AVAILABLE or AVAILABLE
+            continue
+        if not item.get('jellyfinMediaId'):
             continue
 
-        # Check if the item still exists in Jellyfin
-        if jellyfin_media_id and not check_jellyfin_item_exists(jellyfin_media_id):
-            missing_items.append({
-                'id': media_id,
-                'title': title,
-                'type': media_type,
-                'jellyfin_id': jellyfin_media_id
-            })
-            print(f"  Missing: {title} ({media_type})")
-            print(f"           Jellyfin ID: {jellyfin_media_id}")
+        candidate_count += 1
+        pending.append(item)
+        if len(pending) >= JELLYFIN_IDS_CHUNK:
+            missing_items.extend(find_missing_media(pending, known_ids))
+            pending = []
+
+    if pending:
+        missing_items.extend(find_missing_media(pending, known_ids))
+
+    print(f"Found {media_count} available media items in Jellyseerr")
+    print(f"Checked {candidate_count} items against Jellyfin")
+    deleted_count = 0
+
+    metrics.set_items('scanned', media_count)
+    metrics.set_items('checked', candidate_count)
+    metrics.set_items('missing', len(missing_items))
+    metrics.set_items('deleted', 0)
 
     # Show summary
     if not missing_items:
@@ -127,17 +368,28 @@ def main():
     print(f"\nFound {len(missing_items)} missing items.")
     print("\nDeleting missing items from Jellyseerr...")
 
+    deleted_ids = []
+
     for item in missing_items:
         if delete_jellyseerr_media(item['id']):
             print(f"  ✓ Deleted: {item['title']}")
             print(f"    This content can now be requested again!")
+            deleted_ids.append(item['id'])
             deleted_count += 1
         else:
             print(f"  ✗ Failed to delete: {item['title']}")
 
+    forget_jellyseerr_media(deleted_ids)
+    metrics.set_items('deleted', deleted_count)
+
     print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Cleanup complete.")
     print(f"Deleted {deleted_count} of {len(missing_items)} missing items.")
     print(f"Users can now re-request this content!")
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except Exception:
+        metrics.write(success=False)
+        raise
+    metrics.write()
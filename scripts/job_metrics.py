@@ -0,0 +1,227 @@
+"""
+Prometheus textfile output for the maintenance scripts
+
+Each job writes its numbers to METRICS_DIR/<script>.prom in the Prometheus
+text exposition format, for node_exporter's textfile collector (or anything
+else that reads .prom files) to pick up. Dashboards can then query numeric
+series instead of parsing the JSON log lines in Loki.
+
+Every file carries the job's last run time, duration and outcome, plus the
+requests, errors and latency of each upstream it talked to. Series are
+labelled with script=<name> (matching the "script" field of log_json) rather
+than job=, which Prometheus reserves for the scrape job.
+
+Most jobs are one-shot cron runs, so counters and histograms are kept in
+METRICS_DIR/<script>.counters.json and carried over to the next run; otherwise
+every run would look like a counter reset and rate()/increase() would miss it.
+
+Metrics are only ever a side channel: failing to write them is logged and
+never fails the job.
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/metrics')
+
+# Upstream request latency buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class JobMetrics:
+    """Metric families of one script, written out as a whole by write()"""
+
+    def __init__(self, script):
+        self.script = script
+        self.path = os.path.join(METRICS_DIR, f'{script}.prom')
+        self.lock = threading.Lock()
+        self.counters_path = os.path.join(METRICS_DIR, f'{script}.counters.json')
+        # name -> [type, help, {label tuple: value}]
+        self.families = {}
+        self.started = time.time()
+        self.load_counters()
+
+    def load_counters(self):
+        """Carry over counters and histograms written by the previous run"""
+        try:
+            with open(self.counters_path) as f:
+                saved = json.load(f)
+            for name, (kind, help_text, series) in saved.items():
+                values = {}
+                for labels, value in series:
+                    if kind == 'histogram':
+                        value['bounds'] = tuple(value['bounds'])
+                    values[tuple(tuple(label) for label in labels)] = value
+                self.families[name] = [kind, help_text, values]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            # Counters restart from zero, which Prometheus handles as a reset
+            print(f"WARNING: Could not read metric counters from {self.counters_path}: {e}")
+
+    def save_counters(self):
+        with self.lock:
+            saved = {
+                name: [kind, help_text, [[labels, value] for labels, value in values.items()]]
+                for name, (kind, help_text, values) in self.families.items()
+                if kind in ('counter', 'histogram')
+            }
+        tmp_path = self.counters_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, self.counters_path)
+
+    def start(self):
+        """Mark the start of a run (construction already does, for one-shot jobs)"""
+        self.started = time.time()
+
+    def series(self, name, kind, help_text, labels):
+        family = self.families.setdefault(name, [kind, help_text, {}])
+        return family[2], tuple(sorted({'script': self.script, **labels}.items()))
+
+    def set(self, name, help_text, value, **labels):
+        """Set a gauge"""
+        with self.lock:
+            values, key = self.series(name, 'gauge', help_text, labels)
+            values[key] = value
+
+    def clear(self, name):
+        """Drop every series of a gauge, e.g. before re-reporting a per-run set"""
+        with self.lock:
+            family = self.families.get(name)
+            if family:
+                family[2].clear()
+
+    def inc(self, name, help_text, amount=1, **labels):
+        """Increase a counter (name should end in _total)"""
+        with self.lock:
+            values, key = self.series(name, 'counter', help_text, labels)
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, help_text, value, buckets=LATENCY_BUCKETS, **labels):
+        """Add an observation to a histogram"""
+        with self.lock:
+            values, key = self.series(name, 'histogram', help_text, labels)
+            histogram = values.setdefault(key, {'buckets': [0] * len(buckets), 'bounds': buckets,
+                                                'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def set_items(self, stage, count, **labels):
+        """Per-run item count of a cleanup stage (scanned, missing, deleted, ...)"""
+        self.set('homeserver_cleanup_items', 'Items at each stage of the last cleanup run',
+                 count, stage=stage, **labels)
+
+    def request_failed(self, upstream, reason):
+        self.inc('homeserver_upstream_errors_total', 'Failed requests to an upstream service',
+                 upstream=upstream)
+        self.inc('homeserver_upstream_error_reasons_total',
+                 'Failed requests to an upstream service, by HTTP status or exception',
+                 upstream=upstream, reason=reason)
+
+    @contextmanager
+    def request(self, url, expected=()):
+        """
+        Time one upstream request. Exceptions are counted as errors and
+        re-raised; an exception carrying an HTTP status below 400 (urllib
+        raises one for a 304) or in expected is not an error.
+        """
+        upstream = urlsplit(url).hostname or 'unknown'
+        self.inc('homeserver_upstream_requests_total', 'Requests sent to an upstream service',
+                 upstream=upstream)
+        # A contacted upstream always has an error series, even at 0
+        self.inc('homeserver_upstream_errors_total', 'Failed requests to an upstream service',
+                 amount=0, upstream=upstream)
+        started = time.monotonic()
+        try:
+            yield upstream
+        except Exception as e:
+            code = getattr(e, 'code', None)
+            if not isinstance(code, int):
+                self.request_failed(upstream, type(e).__name__)
+            elif code >= 400 and code not in expected:
+                self.request_failed(upstream, str(code))
+            raise
+        finally:
+            self.observe('homeserver_upstream_request_duration_seconds',
+                         'Latency of requests to an upstream service',
+                         time.monotonic() - started, upstream=upstream)
+
+    def instrument(self, session):
+        """Record latency and errors of every request sent through a requests session"""
+        send = session.send
+
+        def timed_send(request, **kwargs):
+            with self.request(request.url) as upstream:
+                response = send(request, **kwargs)
+            if response.status_code >= 400:
+                self.request_failed(upstream, str(response.status_code))
+            return response
+
+        session.send = timed_send
+        return session
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, values) in sorted(self.families.items()):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in sorted(values.items()):
+                    if kind != 'histogram':
+                        lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+                        continue
+                    bounds = list(value['bounds']) + [float('inf')]
+                    counts = value['buckets'] + [value['count']]
+                    for bound, count in zip(bounds, counts):
+                        le = labels + (('le', format_value(bound)),)
+                        lines.append(f'{name}_bucket{format_labels(le)} {count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {format_value(value["sum"])}')
+                    lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, success=True):
+        """
+        Record the run outcome and atomically replace the .prom file, so the
+        collector never reads a half-written one. Long-running modes call start()
+        and write() around every pass; counters and histograms keep accumulating,
+        within the process and across runs.
+        """
+        now = time.time()
+        self.set('homeserver_job_last_run_timestamp_seconds', 'Unix time the job last finished a run', now)
+        self.set('homeserver_job_duration_seconds', 'Duration of the last run', now - self.started)
+        self.set('homeserver_job_success', 'Whether the last run completed (1) or failed (0)', int(success))
+
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp_path, self.path)
+            self.save_counters()
+        except OSError as e:
+            # Not fatal - the job's own output is unaffected
+            print(f"WARNING: Could not write metrics to {self.path}: {e}")
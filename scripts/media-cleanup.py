@@ -6,14 +6,28 @@ When media is deleted from Jellyseerr, this script:
 1. Removes it from Radarr/Sonarr (including files)
 2. Removes associated torrents from qBittorrent
 
-Runs via cron to keep everything in sync.
+Runs via cron to keep everything in sync. With --serve it also runs as a
+webhook receiver that handles single deletions as soon as they are reported.
+Jellyseerr sends no notification when media is deleted, so only Radarr/Sonarr
+deletions are immediate; Jellyseerr deletions are picked up by the reconcile.
 """
 
 import os
 import sys
+import hmac
 import json
+import time
+import fcntl
+import codecs
+import copy
+import argparse
+import threading
 import requests
-from datetime import datetime
+import job_metrics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 
 # Configuration from environment
 JELLYSEERR_URL = os.getenv('JELLYSEERR_URL', 'http://jellyseerr:5055')
@@ -22,105 +36,556 @@ SONARR_URL = os.getenv('SONARR_URL', 'http://sonarr:8989')
 QBITTORRENT_URL = os.getenv('QBITTORRENT_URL', 'http://qbittorrent:8080')
 
 JELLYSEERR_API_KEY = os.getenv('JELLYSEERR_API_KEY', '')
+QBITTORRENT_USERNAME = os.getenv('QBITTORRENT_USERNAME', '')
+QBITTORRENT_PASSWORD = os.getenv('QBITTORRENT_PASSWORD', '')
 RADARR_API_KEY = os.getenv('RADARR_API_KEY', '')
 SONARR_API_KEY = os.getenv('SONARR_API_KEY', '')
 
 # Dry run mode - set to False to actually delete
 DRY_RUN = os.getenv('DRY_RUN', 'true').lower() == 'true'
 
+# Incremental Jellyseerr sync - keep a snapshot of tracked media plus the newest
+# updatedAt seen, and only page through media modified since then. A full walk
+# runs every JELLYSEERR_FULL_SYNC_INTERVAL seconds or when media was removed.
+JELLYSEERR_INCREMENTAL = os.getenv('JELLYSEERR_INCREMENTAL', 'true').lower() == 'true'
+JELLYSEERR_FULL_SYNC_INTERVAL = int(os.getenv('JELLYSEERR_FULL_SYNC_INTERVAL', '86400'))
+JELLYSEERR_PAGE_SIZE = 100
+STATE_FILE = os.getenv('MEDIA_CLEANUP_STATE_FILE', '/tmp/media-cleanup-state.json')
 
-def log(msg):
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+# Inventory sources are fetched concurrently; the run aborts (deletes nothing)
+# if any of them fails or takes longer than this many seconds
+INVENTORY_TIMEOUT = int(os.getenv('INVENTORY_TIMEOUT', '60'))
 
+# Orphans are removed through the *arr editor endpoints in batches of this size
+ARR_DELETE_BATCH_SIZE = int(os.getenv('ARR_DELETE_BATCH_SIZE', '50'))
 
-def get_jellyseerr_media():
-    """Get all media tracked in Jellyseerr"""
-    try:
-        # Get all media requests (approved/available)
-        media_ids = {'movies': set(), 'tv': set()}
-
-        # Prepare headers with API key
-        headers = {}
-        if JELLYSEERR_API_KEY:
-            headers['X-Api-Key'] = JELLYSEERR_API_KEY
-
-        # Fetch movies
-        page = 1
-        while True:
-            response = requests.get(
-                f'{JELLYSEERR_URL}/api/v1/media',
-                headers=headers,
-                params={'take': 100, 'skip': (page - 1) * 100},
-                timeout=30
-            )
-            if response.status_code != 200:
-                log(f"Failed to fetch Jellyseerr media: {response.status_code}")
-                break
+# Incremental qBittorrent sync - keep the sync/maindata rid, its WebUI session
+# cookie and a local torrent table, and only check new/changed torrents on disk.
+# When the session has expired qBittorrent sends a full update, which is diffed
+# against the table instead. Every torrent is checked again every
+# QBITTORRENT_SWEEP_INTERVAL seconds.
+QBITTORRENT_INCREMENTAL = os.getenv('QBITTORRENT_INCREMENTAL', 'true').lower() == 'true'
+QBITTORRENT_SWEEP_INTERVAL = int(os.getenv('QBITTORRENT_SWEEP_INTERVAL', '3600'))
 
-            data = response.json()
-            results = data.get('results', [])
+# Max hashes per torrents/info or torrents/delete call (pipe-joined)
+QBITTORRENT_BATCH_SIZE = int(os.getenv('QBITTORRENT_BATCH_SIZE', '100'))
 
-            if not results:
-                break
+# Webhook receiver (--serve) - Jellyseerr/Radarr/Sonarr POST to /jellyseerr,
+# /radarr and /sonarr. Events are deduplicated, handled after WEBHOOK_DELAY
+# seconds and retried with backoff. Jellyseerr has no media-deleted
+# notification, so its deletions still wait for the reconcile, which runs every
+# RECONCILE_INTERVAL seconds - the same 15 minutes as the cron run it replaces
+# (cron runs skip themselves while --serve holds the lock).
+WEBHOOK_PORT = int(os.getenv('MEDIA_CLEANUP_WEBHOOK_PORT', '8095'))
+WEBHOOK_TOKEN = os.getenv('MEDIA_CLEANUP_WEBHOOK_TOKEN', '')
+WEBHOOK_DELAY = int(os.getenv('MEDIA_CLEANUP_WEBHOOK_DELAY', '5'))
+WEBHOOK_MAX_RETRIES = int(os.getenv('MEDIA_CLEANUP_WEBHOOK_MAX_RETRIES', '5'))
+RECONCILE_INTERVAL = int(os.getenv('MEDIA_CLEANUP_RECONCILE_INTERVAL', '900'))
 
-            for item in results:
-                media_type = item.get('mediaType')
-                tmdb_id = item.get('tmdbId')
-                tvdb_id = item.get('tvdbId')
+# Held by the webhook receiver (and each cron run) so they never overlap
+LOCK_FILE = os.getenv('MEDIA_CLEANUP_LOCK_FILE', '/tmp/media-cleanup.lock')
 
-                if media_type == 'movie' and tmdb_id:
-                    media_ids['movies'].add(tmdb_id)
-                elif media_type == 'tv' and tvdb_id:
-                    media_ids['tv'].add(tvdb_id)
+# Run outcome, item counts and per-upstream latency/errors for the Prometheus
+# textfile collector; every API request goes through an instrumented session
+metrics = job_metrics.JobMetrics('media-cleanup')
+session = metrics.instrument(requests.Session())
 
-            if len(results) < 100:
-                break
-            page += 1
 
-        log(f"Jellyseerr tracking: {len(media_ids['movies'])} movies, {len(media_ids['tv'])} TV shows")
-        return media_ids
+def log(msg):
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
 
-    except Exception as e:
-        log(f"Error fetching Jellyseerr media: {e}")
-        return {'movies': set(), 'tv': set()}
 
+class QBittorrentClient:
+    """
+    Minimal qBittorrent Web API client.
+    Logs in once (if credentials are set) and reuses the SID cookie over a
+    keep-alive session; hash lists are sent pipe-joined in batches.
+    """
 
-def get_radarr_movies():
-    """Get all movies in Radarr"""
-    try:
-        response = requests.get(
-            f'{RADARR_URL}/api/v3/movie',
-            headers={'X-Api-Key': RADARR_API_KEY},
+    def __init__(self, url, username='', password=''):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.session = metrics.instrument(requests.Session())
+        self.logged_in = False
+
+    def login(self):
+        """Authenticate and keep the SID cookie (no-op without credentials)"""
+        if not self.username:
+            # Auth bypass for whitelisted subnets
+            return
+
+        response = self.session.post(
+            f'{self.url}/api/v2/auth/login',
+            data={'username': self.username, 'password': self.password},
+            headers={'Referer': self.url},
             timeout=30
         )
         response.raise_for_status()
-        movies = response.json()
+        if response.text.strip() != 'Ok.':
+            raise RuntimeError('qBittorrent login failed - check QBITTORRENT_USERNAME/PASSWORD')
+        self.logged_in = True
+
+    def request(self, method, path, **kwargs):
+        """Send a request, logging in first and once more if the session expired"""
+        if self.username and not self.logged_in:
+            self.login()
+
+        kwargs.setdefault('timeout', 30)
+        response = self.session.request(method, f'{self.url}{path}', **kwargs)
+
+        if response.status_code == 403 and self.username:
+            self.login()
+            response = self.session.request(method, f'{self.url}{path}', **kwargs)
+
+        response.raise_for_status()
+        return response
+
+    def torrents_info(self, hashes=None, **params):
+        """List torrents, optionally only the given hashes"""
+        if hashes is None:
+            return self.request('GET', '/api/v2/torrents/info', params=params).json()
+
+        hashes = list(hashes)
+        torrents = []
+        for start in range(0, len(hashes), QBITTORRENT_BATCH_SIZE):
+            batch = hashes[start:start + QBITTORRENT_BATCH_SIZE]
+            torrents.extend(self.request(
+                'GET', '/api/v2/torrents/info', params={**params, 'hashes': '|'.join(batch)}
+            ).json())
+        return torrents
 
-        # Return dict: tmdbId -> movie data
-        return {m['tmdbId']: m for m in movies}
+    def export_sid(self):
+        """The WebUI session cookie (None without one), to resume the session in a later run"""
+        return self.session.cookies.get('SID')
 
+    def restore_sid(self, sid):
+        """Reuse a session cookie from an earlier run; a 403 still triggers a fresh login"""
+        if sid:
+            self.session.cookies.set('SID', sid)
+            self.logged_in = True
+
+    def sync_maindata(self, rid=0):
+        """Incremental state since rid (only meaningful within the same WebUI session)"""
+        return self.request('GET', '/api/v2/sync/maindata', params={'rid': rid}).json()
+
+    def delete_torrents(self, hashes, delete_files=False):
+        """Remove torrents in pipe-joined batches; returns the hashes that were removed"""
+        hashes = list(hashes)
+        removed = []
+        for start in range(0, len(hashes), QBITTORRENT_BATCH_SIZE):
+            batch = hashes[start:start + QBITTORRENT_BATCH_SIZE]
+            try:
+                self.request(
+                    'POST', '/api/v2/torrents/delete',
+                    data={'hashes': '|'.join(batch), 'deleteFiles': 'true' if delete_files else 'false'}
+                )
+                removed.extend(batch)
+            except Exception as e:
+                log(f"  Error removing {len(batch)} torrent(s) from qBittorrent: {e}")
+        return removed
+
+
+qbittorrent = QBittorrentClient(QBITTORRENT_URL, QBITTORRENT_USERNAME, QBITTORRENT_PASSWORD)
+
+
+def load_state():
+    """Load persisted sync state (empty dict if missing or unreadable)"""
+    try:
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
     except Exception as e:
-        log(f"Error fetching Radarr movies: {e}")
+        log(f"WARNING: Could not read state file {STATE_FILE}: {e}")
         return {}
 
 
-def get_sonarr_series():
-    """Get all series in Sonarr"""
+def save_state(state):
+    """Atomically write sync state to disk"""
     try:
-        response = requests.get(
-            f'{SONARR_URL}/api/v3/series',
-            headers={'X-Api-Key': SONARR_API_KEY},
-            timeout=30
-        )
+        tmp_file = f"{STATE_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, STATE_FILE)
+    except Exception as e:
+        # Not fatal - next run simply falls back to a full sync
+        log(f"WARNING: Could not write state file {STATE_FILE}: {e}")
+
+
+def get_jellyseerr_page(headers, skip, sort=None):
+    """Fetch one page of Jellyseerr media (default order by ID, or sort='modified')"""
+    params = {'take': JELLYSEERR_PAGE_SIZE, 'skip': skip}
+    if sort:
+        params['sort'] = sort
+    response = session.get(
+        f'{JELLYSEERR_URL}/api/v1/media',
+        headers=headers,
+        params=params,
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def merge_jellyseerr_items(media, items):
+    """Store media ID -> [mediaType, tmdbId, tvdbId]; returns newest updatedAt in items"""
+    newest = ''
+    for item in items:
+        media[str(item['id'])] = [item.get('mediaType'), item.get('tmdbId'), item.get('tvdbId')]
+        newest = max(newest, item.get('updatedAt') or '')
+    return newest
+
+
+def sync_jellyseerr_full(headers):
+    """
+    Walk every page of Jellyseerr media. Returns (media, newest updatedAt).
+    Pages are taken in the stable ID order - under sort=modified an item updated
+    mid-walk jumps to page 0 and would be missed, and then treated as untracked.
+    Raises if the walk did not see as many items as Jellyseerr reports.
+    """
+    media = {}
+    newest = ''
+    total = None
+    skip = 0
+
+    while True:
+        data = get_jellyseerr_page(headers, skip)
+        results = data.get('results', [])
+        total = data.get('pageInfo', {}).get('results', total)
+        if not results:
+            break
+
+        newest = max(newest, merge_jellyseerr_items(media, results))
+
+        if len(results) < JELLYSEERR_PAGE_SIZE:
+            break
+        skip += JELLYSEERR_PAGE_SIZE
+
+    # Media added or removed mid-walk shifts the pages - fail closed
+    if total is not None and total != len(media):
+        raise RuntimeError(f"Jellyseerr reports {total} media but the walk saw {len(media)}")
+
+    return media, newest
+
+
+def sync_jellyseerr_incremental(headers, snapshot):
+    """
+    Page through media modified since the snapshot, newest first, stopping at
+    the first already-seen record. Returns (media, newest updatedAt), or None
+    when media was removed from Jellyseerr and a full walk is needed.
+    """
+    media = snapshot['media']
+    watermark = snapshot['updated_at']
+    newest = watermark
+    total = None
+    skip = 0
+
+    while True:
+        data = get_jellyseerr_page(headers, skip, sort='modified')
+        results = data.get('results', [])
+        if total is None:
+            total = data.get('pageInfo', {}).get('results')
+
+        changed = [item for item in results if (item.get('updatedAt') or '') >= watermark]
+        newest = max(newest, merge_jellyseerr_items(media, changed))
+
+        if len(changed) < len(results) or len(results) < JELLYSEERR_PAGE_SIZE:
+            break
+        skip += JELLYSEERR_PAGE_SIZE
+
+    # New and changed media were all merged above, so the counts only differ
+    # when something was deleted (which is not visible in a modified-sorted list)
+    if total != len(media):
+        log(f"Jellyseerr has {total} media, snapshot has {len(media)} - running full sync")
+        return None
+
+    log(f"Jellyseerr incremental sync: {skip // JELLYSEERR_PAGE_SIZE + 1} page(s) fetched")
+    return media, newest
+
+
+def snapshot_is_fresh(snapshot, now):
+    """True if the Jellyseerr snapshot is usable and its full sync is recent enough"""
+    if not snapshot or not {'updated_at', 'last_full_sync', 'media'} <= snapshot.keys():
+        return False
+
+    try:
+        last_full_sync = datetime.fromisoformat(snapshot['last_full_sync'])
+    except (TypeError, ValueError):
+        return False
+
+    return (now - last_full_sync).total_seconds() < JELLYSEERR_FULL_SYNC_INTERVAL
+
+
+def get_jellyseerr_media(state):
+    """Get all media tracked in Jellyseerr (updates the snapshot in state)"""
+    # Get all media requests (approved/available)
+    media_ids = {'movies': set(), 'tv': set()}
+
+    # Prepare headers with API key
+    headers = {}
+    if JELLYSEERR_API_KEY:
+        headers['X-Api-Key'] = JELLYSEERR_API_KEY
+
+    now = datetime.now(timezone.utc)
+    snapshot = state.get('jellyseerr')
+
+    result = None
+    if JELLYSEERR_INCREMENTAL and snapshot_is_fresh(snapshot, now):
+        result = sync_jellyseerr_incremental(headers, snapshot)
+
+    if result is None:
+        media, newest = sync_jellyseerr_full(headers)
+        last_full_sync = now.isoformat()
+    else:
+        media, newest = result
+        last_full_sync = snapshot['last_full_sync']
+
+    if JELLYSEERR_INCREMENTAL:
+        state['jellyseerr'] = {
+            'updated_at': newest,
+            'last_full_sync': last_full_sync,
+            'media': media
+        }
+
+    for media_type, tmdb_id, tvdb_id in media.values():
+        if media_type == 'movie' and tmdb_id:
+            media_ids['movies'].add(tmdb_id)
+        elif media_type == 'tv' and tvdb_id:
+            media_ids['tv'].add(tvdb_id)
+
+    log(f"Jellyseerr tracking: {len(media_ids['movies'])} movies, {len(media_ids['tv'])} TV shows")
+    return media_ids
+
+
+class ArrItem:
+    """Projected Radarr/Sonarr record - only what reconciliation needs"""
+    __slots__ = ('id', 'title')
+
+    def __init__(self, item_id, title):
+        self.id = item_id
+        self.title = title
+
+
+def iter_json_array(response, chunk_size=65536):
+    """
+    Yield the elements of a top-level JSON array from a streamed response one
+    at a time, so the full payload is never held in memory at once. An element
+    is only decoded once the ',' or ']' after it has arrived, so a number split
+    across chunks is not read as two.
+    """
+    text = codecs.getincrementaldecoder('utf-8')()
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    started = False
+    done = False
+
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        buffer = buffer[pos:] + text.decode(chunk)
+        pos = 0
+
+        while not done:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError('expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                done = True
+                break
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element continues in the next chunk
+                break
+            while end < len(buffer) and buffer[end] in ' \t\r\n':
+                end += 1
+            if end >= len(buffer):
+                # No delimiter yet - the element may continue in the next chunk
+                break
+            if buffer[end] not in ',]':
+                raise ValueError('expected , or ] after a JSON array element')
+            pos = end
+            yield element
+
+    if not done:
+        raise ValueError('truncated JSON array')
+
+
+def get_arr_items(url, api_key, external_id_field, params=None):
+    """Stream an *arr library and return {external ID: ArrItem}"""
+    items = {}
+    with session.get(url, headers={'X-Api-Key': api_key}, params=params, timeout=30, stream=True) as response:
         response.raise_for_status()
-        series = response.json()
+        for entry in iter_json_array(response):
+            items[entry[external_id_field]] = ArrItem(entry['id'], entry['title'])
+    return items
 
-        # Return dict: tvdbId -> series data
-        return {s['tvdbId']: s for s in series}
 
-    except Exception as e:
-        log(f"Error fetching Sonarr series: {e}")
-        return {}
+def get_radarr_movies():
+    """Get all movies in Radarr: tmdbId -> ArrItem"""
+    return get_arr_items(f'{RADARR_URL}/api/v3/movie', RADARR_API_KEY, 'tmdbId')
+
+
+def get_sonarr_series():
+    """Get all series in Sonarr: tvdbId -> ArrItem"""
+    return get_arr_items(f'{SONARR_URL}/api/v3/series', SONARR_API_KEY, 'tvdbId')
+
+
+def get_qbittorrent_torrents(state):
+    """
+    Get completed torrents in qBittorrent that need a filesystem check.
+    In incremental mode only torrents that are new or changed since the last
+    sync/maindata rid are returned, except on periodic sweeps.
+    """
+    if not QBITTORRENT_INCREMENTAL:
+        return qbittorrent.torrents_info(filter='completed')
+
+    table = state.get('qbittorrent') or {}
+    previous = table.get('torrents', {})
+
+    # qBittorrent tracks the rid per WebUI session, so resume the session the rid belongs to
+    qbittorrent.restore_sid(table.get('sid'))
+    data = qbittorrent.sync_maindata(table.get('rid', 0))
+
+    # A full update (new session, or rid 0) lists every torrent: start from an empty
+    # table, which drops torrents that are gone, but still compare against the
+    # previous table so only torrents that really changed are checked again
+    full_update = bool(data.get('full_update'))
+    torrents = {} if full_update else previous
+
+    changed = set()
+    for torrent_hash, fields in data.get('torrents', {}).items():
+        before = dict(previous.get(torrent_hash, {}))
+        entry = {} if full_update else torrents.setdefault(torrent_hash, {})
+        entry.update({key: fields[key] for key in ('name', 'content_path', 'progress', 'state') if key in fields})
+        torrents[torrent_hash] = entry
+        if entry != before:
+            changed.add(torrent_hash)
+
+    for torrent_hash in data.get('torrents_removed', []):
+        torrents.pop(torrent_hash, None)
+        changed.discard(torrent_hash)
+
+    now = datetime.now(timezone.utc)
+    last_sweep = table.get('last_sweep')
+    sweep = not last_sweep or (now - datetime.fromisoformat(last_sweep)).total_seconds() >= QBITTORRENT_SWEEP_INTERVAL
+
+    state['qbittorrent'] = {
+        'rid': data.get('rid', 0),
+        'sid': qbittorrent.export_sid(),
+        'torrents': torrents,
+        'last_sweep': now.isoformat() if sweep else last_sweep
+    }
+
+    to_check = torrents.keys() if sweep else changed
+    log(f"qBittorrent: {len(torrents)} torrents tracked{' (full update)' if full_update else ''}, checking "
+        f"{'all' if sweep else len(to_check)}{' (sweep)' if sweep else ''}")
+
+    # Same as filter=completed
+    return [
+        {'hash': torrent_hash, **torrents[torrent_hash]}
+        for torrent_hash in to_check
+        if torrents[torrent_hash].get('progress', 0) >= 1
+    ]
+
+
+def get_download_index(state, app, url, api_key, id_field):
+    """
+    Map torrent hash -> *arr media ID from grab history (history downloadId).
+    The index is kept in state and extended with /history/since on each run.
+    """
+    downloads = state.setdefault('downloads', {})
+    index = downloads.get(app) or {'since': '1970-01-01T00:00:00Z', 'hashes': {}}
+    now = datetime.now(timezone.utc)
+
+    response = session.get(
+        f'{url}/api/v3/history/since',
+        headers={'X-Api-Key': api_key},
+        # eventType 1 = grabbed (the event that records the torrent hash)
+        params={'date': index['since'], 'eventType': 1},
+        timeout=60
+    )
+    response.raise_for_status()
+
+    for record in response.json():
+        download_id = record.get('downloadId')
+        if download_id and record.get(id_field):
+            index['hashes'][download_id.lower()] = record[id_field]
+
+    index['since'] = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+    downloads[app] = index
+    return index['hashes']
+
+
+def copy_section(state, path):
+    """A private state dict holding a deep copy of the state section at path (a key tuple)"""
+    local = node = {}
+    for key in path[:-1]:
+        state = state.get(key) or {}
+        node = node.setdefault(key, {})
+    if path and path[-1] in state:
+        node[path[-1]] = copy.deepcopy(state[path[-1]])
+    return local
+
+
+def merge_section(state, local, path):
+    """Store the state section at path that a fetch left in its private state dict"""
+    for key in path[:-1]:
+        local = local.get(key) or {}
+        state = state.setdefault(key, {})
+    if path and path[-1] in local:
+        state[path[-1]] = local[path[-1]]
+
+
+def collect_inventory(state):
+    """
+    Fetch Jellyseerr, Radarr, Sonarr and qBittorrent concurrently.
+    Returns a dict of results, or None if any source failed or timed out
+    (fail closed - never delete based on partial data).
+    """
+    # name -> (state section the fetch updates, fetch taking a state dict)
+    sources = {
+        'Jellyseerr': (('jellyseerr',), get_jellyseerr_media),
+        'Radarr': ((), lambda local: get_radarr_movies()),
+        'Sonarr': ((), lambda local: get_sonarr_series()),
+        'qBittorrent': (('qbittorrent',), get_qbittorrent_torrents),
+        'Radarr downloads': (('downloads', 'radarr'), lambda local: get_download_index(
+            local, 'radarr', RADARR_URL, RADARR_API_KEY, 'movieId')),
+        'Sonarr downloads': (('downloads', 'sonarr'), lambda local: get_download_index(
+            local, 'sonarr', SONARR_URL, SONARR_API_KEY, 'seriesId')),
+    }
+
+    # Fetches that time out keep running in the background, so each one works on
+    # its own copy of its state section, merged back only once it has succeeded
+    local_states = {name: copy_section(state, path) for name, (path, _) in sources.items()}
+
+    executor = ThreadPoolExecutor(max_workers=len(sources))
+    futures = {name: executor.submit(fetch, local_states[name]) for name, (_, fetch) in sources.items()}
+    done, not_done = wait(futures.values(), timeout=INVENTORY_TIMEOUT)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    inventory = {}
+    failed = False
+
+    for name, future in futures.items():
+        if future in not_done:
+            log(f"Error fetching {name}: timed out after {INVENTORY_TIMEOUT}s")
+            failed = True
+        elif future.exception():
+            log(f"Error fetching {name}: {future.exception()}")
+            failed = True
+        else:
+            inventory[name] = future.result()
+            merge_section(state, local_states[name], sources[name][0])
+
+    return None if failed else inventory
 
 
 def delete_from_radarr(movie_id, movie_title, delete_files=True):
@@ -130,7 +595,7 @@ def delete_from_radarr(movie_id, movie_title, delete_files=True):
             log(f"  [DRY RUN] Would delete from Radarr: {movie_title}")
             return True
 
-        response = requests.delete(
+        response = session.delete(
             f'{RADARR_URL}/api/v3/movie/{movie_id}',
             headers={'X-Api-Key': RADARR_API_KEY},
             params={'deleteFiles': delete_files, 'addImportExclusion': False},
@@ -156,7 +621,7 @@ def delete_from_sonarr(series_id, series_title, delete_files=True):
             log(f"  [DRY RUN] Would delete from Sonarr: {series_title}")
             return True
 
-        response = requests.delete(
+        response = session.delete(
             f'{SONARR_URL}/api/v3/series/{series_id}',
             headers={'X-Api-Key': SONARR_API_KEY},
             params={'deleteFiles': delete_files, 'addImportListExclusion': False},
@@ -175,76 +640,181 @@ def delete_from_sonarr(series_id, series_title, delete_files=True):
         return False
 
 
-def cleanup_qbittorrent_orphans():
-    """Remove completed torrents that are no longer needed"""
-    try:
-        # Get all completed torrents
-        response = requests.get(
-            f'{QBITTORRENT_URL}/api/v2/torrents/info',
-            params={'filter': 'completed'},
-            timeout=30
-        )
+def delete_batch_from_arr(app, url, api_key, ids_key, exclusion_key, items, delete_one):
+    """
+    Delete items through an *arr editor endpoint, ARR_DELETE_BATCH_SIZE at a time.
+    A batch that fails falls back to per-item deletes; results are logged per item.
+    Returns the IDs that were deleted (or would be, in dry run).
+    """
+    if DRY_RUN:
+        for item in items:
+            log(f"  [DRY RUN] Would delete from {app}: {item.title}")
+        return {item.id for item in items}
+
+    deleted_ids = set()
+
+    for start in range(0, len(items), ARR_DELETE_BATCH_SIZE):
+        batch = items[start:start + ARR_DELETE_BATCH_SIZE]
+
+        try:
+            response = session.delete(
+                url,
+                headers={'X-Api-Key': api_key},
+                json={ids_key: [item.id for item in batch], 'deleteFiles': True, exclusion_key: False},
+                timeout=120
+            )
+            ok = response.status_code in [200, 204]
+            if not ok:
+                log(f"  Batch delete from {app} failed - {response.status_code}, retrying one by one")
+        except Exception as e:
+            ok = False
+            log(f"  Error batch deleting from {app}: {e}, retrying one by one")
+
+        if ok:
+            for item in batch:
+                log(f"  Deleted from {app}: {item.title}")
+                deleted_ids.add(item.id)
+        else:
+            for item in batch:
+                if delete_one(item.id, item.title):
+                    deleted_ids.add(item.id)
+
+    return deleted_ids
+
+
+def delete_movies_from_radarr(movies):
+    """Delete movies (and their files) from Radarr in batches"""
+    return delete_batch_from_arr('Radarr', f'{RADARR_URL}/api/v3/movie/editor', RADARR_API_KEY,
+                          'movieIds', 'addImportExclusion', movies, delete_from_radarr)
+
+
+def delete_series_from_sonarr(series):
+    """Delete series (and their files) from Sonarr in batches"""
+    return delete_batch_from_arr('Sonarr', f'{SONARR_URL}/api/v3/series/editor', SONARR_API_KEY,
+                          'seriesIds', 'addImportListExclusion', series, delete_from_sonarr)
 
-        if response.status_code != 200:
-            log(f"Failed to fetch qBittorrent torrents: {response.status_code}")
-            return
 
-        torrents = response.json()
-        orphan_count = 0
+def remove_torrents_by_hash(download_index, orphan_hashes):
+    """
+    Remove the given torrents (grabbed for media that no longer exists) with their files.
+    download_index: {app: {hash: media_id}}
+    Hashes resolved here (or already gone from qBittorrent) are dropped from the index.
+    Returns the number of torrents removed (or that would be, in dry run).
+    """
+    if not orphan_hashes:
+        return 0
+
+    # One lookup for exactly these hashes - no full torrent list scan
+    present = {torrent['hash'].lower(): torrent for torrent in qbittorrent.torrents_info(orphan_hashes)}
+    removed = set(orphan_hashes) - set(present)
+
+    if DRY_RUN:
+        for torrent in present.values():
+            log(f"  [DRY RUN] Would remove torrent of deleted media: {torrent.get('name', 'Unknown')}")
+        return len(present)
+
+    # The media is gone from Radarr/Sonarr, so the downloaded copy goes too
+    deleted = qbittorrent.delete_torrents(present, delete_files=True)
+    for torrent_hash in deleted:
+        log(f"  Removed torrent of deleted media: {present[torrent_hash].get('name', 'Unknown')}")
+        removed.add(torrent_hash)
+
+    for hashes in download_index.values():
+        for torrent_hash in removed:
+            hashes.pop(torrent_hash, None)
+
+    return len(deleted)
+
+
+def hashes_of_deleted_media(download_index, remaining_ids, newest_ids):
+    """
+    Hashes of torrents whose Radarr/Sonarr media no longer exists.
+    download_index: {app: {hash: media_id}}, remaining_ids: {app: set of media IDs},
+    newest_ids: {app: highest media ID in the fetched list}
+    History is fetched alongside the media lists, so it can hold grabs for media
+    added after the list was fetched - IDs above the newest one are left alone.
+    """
+    return [
+        torrent_hash
+        for app, hashes in download_index.items()
+        for torrent_hash, media_id in hashes.items()
+        if media_id <= newest_ids[app] and media_id not in remaining_ids[app]
+    ]
+
+
+def cleanup_qbittorrent_orphans(torrents, resolved_hashes=frozenset()):
+    """
+    Remove completed torrents whose files are gone.
+    Torrents in resolved_hashes belong to deleted media and were already handled
+    by hash, so they are not probed on disk.
+    Returns the number of torrents removed (or that would be, in dry run).
+    """
+    try:
+        orphans = {}
+        dry_run_count = 0
 
         for torrent in torrents:
-            save_path = torrent.get('save_path', '')
+            torrent_hash = torrent.get('hash', '')
+            if torrent_hash.lower() in resolved_hashes:
+                continue
+
             content_path = torrent.get('content_path', '')
             name = torrent.get('name', 'Unknown')
-            torrent_hash = torrent.get('hash', '')
 
             # Check if the download location still exists
             # If Radarr/Sonarr deleted the files, we can remove the torrent
             if content_path and not os.path.exists(content_path):
                 if DRY_RUN:
                     log(f"  [DRY RUN] Would remove orphan torrent: {name}")
+                    dry_run_count += 1
                 else:
-                    # Remove torrent (files already gone)
-                    del_response = requests.post(
-                        f'{QBITTORRENT_URL}/api/v2/torrents/delete',
-                        data={'hashes': torrent_hash, 'deleteFiles': 'false'},
-                        timeout=30
-                    )
-                    if del_response.status_code == 200:
-                        log(f"  Removed orphan torrent: {name}")
-                        orphan_count += 1
-
-        if orphan_count > 0:
-            log(f"Cleaned up {orphan_count} orphan torrent(s) from qBittorrent")
+                    orphans[torrent_hash] = name
+
+        # Remove all orphans in batched calls (files already gone)
+        removed = qbittorrent.delete_torrents(orphans, delete_files=False)
+        for torrent_hash in removed:
+            log(f"  Removed orphan torrent: {orphans[torrent_hash]}")
+
+        if removed:
+            log(f"Cleaned up {len(removed)} orphan torrent(s) from qBittorrent")
+
+        return dry_run_count + len(removed)
 
     except Exception as e:
         log(f"Error cleaning qBittorrent: {e}")
+        return 0
 
 
-def main():
-    log("=" * 60)
-    log("Media Cleanup - Jellyseerr as Source of Truth")
-    log("=" * 60)
+def reconcile(state):
+    """
+    Full reconcile: delete everything in Radarr/Sonarr that Jellyseerr no longer
+    tracks, then their torrents. Returns False if the inventory was incomplete.
+    """
+    # Fetch what Jellyseerr is tracking and what Radarr/Sonarr/qBittorrent have
+    inventory = collect_inventory(state)
 
-    if DRY_RUN:
-        log("MODE: DRY RUN (no actual deletions)")
-    else:
-        log("MODE: LIVE (will delete orphaned media)")
+    if inventory is None:
+        log("ERROR: Inventory incomplete. Aborting to prevent accidental deletion.")
+        return False
 
-    # Get what Jellyseerr is tracking
-    jellyseerr_media = get_jellyseerr_media()
+    save_state(state)
+    jellyseerr_media = inventory['Jellyseerr']
+    radarr_movies = inventory['Radarr']
+    sonarr_series = inventory['Sonarr']
 
     if not jellyseerr_media['movies'] and not jellyseerr_media['tv']:
         log("WARNING: No media found in Jellyseerr. Aborting to prevent accidental deletion.")
-        return
-
-    # Get what Radarr/Sonarr have
-    radarr_movies = get_radarr_movies()
-    sonarr_series = get_sonarr_series()
+        return True
 
     log(f"Radarr has: {len(radarr_movies)} movies")
     log(f"Sonarr has: {len(sonarr_series)} TV shows")
 
+    metrics.set_items('tracked', len(jellyseerr_media['movies']), kind='movie')
+    metrics.set_items('tracked', len(jellyseerr_media['tv']), kind='series')
+    metrics.set_items('scanned', len(radarr_movies), kind='movie')
+    metrics.set_items('scanned', len(sonarr_series), kind='series')
+    metrics.set_items('scanned', len(inventory['qBittorrent']), kind='torrent')
+
     # Find orphans in Radarr (not in Jellyseerr)
     orphan_movies = []
     for tmdb_id, movie in radarr_movies.items():
@@ -260,25 +830,329 @@ def main():
     log("")
     log(f"Found {len(orphan_movies)} orphan movie(s) in Radarr")
     log(f"Found {len(orphan_series)} orphan TV show(s) in Sonarr")
+    metrics.set_items('missing', len(orphan_movies), kind='movie')
+    metrics.set_items('missing', len(orphan_series), kind='series')
 
     # Delete orphan movies
+    deleted_movie_ids = set()
     if orphan_movies:
         log("")
         log("Cleaning orphan movies from Radarr...")
-        for movie in orphan_movies:
-            delete_from_radarr(movie['id'], movie['title'])
+        deleted_movie_ids = delete_movies_from_radarr(orphan_movies)
 
     # Delete orphan series
+    deleted_series_ids = set()
     if orphan_series:
         log("")
         log("Cleaning orphan TV shows from Sonarr...")
-        for series in orphan_series:
-            delete_from_sonarr(series['id'], series['title'])
+        deleted_series_ids = delete_series_from_sonarr(orphan_series)
 
-    # Clean up orphan torrents
+    # Clean up orphan torrents - torrents grabbed for deleted media are resolved
+    # by hash, everything else (including torrents of media that still exists,
+    # whose files may have been removed by hand) falls back to checking its files on disk
     log("")
     log("Checking for orphan torrents in qBittorrent...")
-    cleanup_qbittorrent_orphans()
+    download_index = {'radarr': inventory['Radarr downloads'], 'sonarr': inventory['Sonarr downloads']}
+    remaining_ids = {
+        'radarr': {movie.id for movie in radarr_movies.values()} - deleted_movie_ids,
+        'sonarr': {series.id for series in sonarr_series.values()} - deleted_series_ids,
+    }
+    newest_ids = {
+        'radarr': max((movie.id for movie in radarr_movies.values()), default=0),
+        'sonarr': max((series.id for series in sonarr_series.values()), default=0),
+    }
+    orphan_hashes = hashes_of_deleted_media(download_index, remaining_ids, newest_ids)
+    removed_torrents = 0
+    try:
+        removed_torrents = remove_torrents_by_hash(download_index, orphan_hashes)
+    except Exception as e:
+        log(f"Error removing torrents of deleted media: {e}")
+
+    removed_torrents += cleanup_qbittorrent_orphans(inventory['qBittorrent'], set(orphan_hashes))
+    save_state(state)
+
+    metrics.set_items('deleted', len(deleted_movie_ids), kind='movie')
+    metrics.set_items('deleted', len(deleted_series_ids), kind='series')
+    metrics.set_items('deleted', removed_torrents, kind='torrent')
+
+    return True
+
+
+def acquire_lock():
+    """Take the cleanup lock without blocking; returns the open file or None"""
+    lock = open(LOCK_FILE, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def to_int(value):
+    """Webhook IDs arrive as numbers or (templated) strings; None if absent"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class EventQueue:
+    """
+    Deduplicating delay queue for webhook events.
+    An event that is already waiting is not queued twice, so a burst of
+    notifications for the same media is handled once.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.events = {}  # key -> (due, attempt)
+
+    def put(self, key, delay=0, attempt=0):
+        with self.condition:
+            if key in self.events:
+                return False
+            self.events[key] = (time.monotonic() + delay, attempt)
+            self.condition.notify()
+            return True
+
+    def get(self, timeout):
+        """Next due (key, attempt), or None once timeout seconds pass"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                ready = [(due, key) for key, (due, _) in self.events.items() if due <= now]
+                if ready:
+                    key = min(ready, key=lambda entry: entry[0])[1]
+                    return key, self.events.pop(key)[1]
+                if now >= deadline:
+                    return None
+                next_due = min([due for due, _ in self.events.values()] + [deadline])
+                self.condition.wait(next_due - now)
+
+
+def parse_webhook(source, payload):
+    """Turn a webhook payload into queue keys (empty for events that need no action)"""
+    if source == 'jellyseerr':
+        media = payload.get('media') or {}
+        media_type = media.get('media_type')
+        tmdb_id = to_int(media.get('tmdbId'))
+        if media_type in ('movie', 'tv') and tmdb_id:
+            return [('media', media_type, tmdb_id, to_int(media.get('tvdbId')))]
+    elif source == 'radarr' and payload.get('eventType') == 'MovieDelete':
+        movie_id = to_int((payload.get('movie') or {}).get('id'))
+        if movie_id:
+            return [('radarr', movie_id)]
+    elif source == 'sonarr' and payload.get('eventType') == 'SeriesDelete':
+        series_id = to_int((payload.get('series') or {}).get('id'))
+        if series_id:
+            return [('sonarr', series_id)]
+    return []
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accepts POST /jellyseerr, /radarr and /sonarr and queues the affected media"""
+
+    queue = None
+
+    def authorized(self):
+        if not WEBHOOK_TOKEN:
+            return True
+        url = urlparse(self.path)
+        supplied = parse_qs(url.query).get('token', [''])[0] or self.headers.get('Authorization', '')
+        if supplied.startswith('Bearer '):
+            supplied = supplied[len('Bearer '):]
+        return hmac.compare_digest(supplied.encode(), WEBHOOK_TOKEN.encode())
+
+    def reply(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.reply(200, 'ok')
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        source = urlparse(self.path).path.strip('/')
+        if source not in ('jellyseerr', 'radarr', 'sonarr'):
+            self.reply(404)
+            return
+        if not self.authorized():
+            self.reply(401)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except (ValueError, json.JSONDecodeError):
+            self.reply(400, 'invalid JSON')
+            return
+
+        keys = parse_webhook(source, payload if isinstance(payload, dict) else {})
+        metrics.inc('homeserver_webhook_requests_total', 'Webhook notifications received',
+                    source=source, actionable=str(bool(keys)).lower())
+        for key in keys:
+            if self.queue.put(key, delay=WEBHOOK_DELAY):
+                log(f"Webhook from {source}: queued {key}")
+        self.reply(202 if keys else 200)
+
+    def log_message(self, format, *args):
+        # Request lines are noise - queued events are logged above
+        pass
+
+
+def jellyseerr_tracks(media_type, tmdb_id):
+    """True if Jellyseerr still has media for this TMDB ID (raises on API errors)"""
+    headers = {'X-Api-Key': JELLYSEERR_API_KEY} if JELLYSEERR_API_KEY else {}
+    response = session.get(f'{JELLYSEERR_URL}/api/v1/{media_type}/{tmdb_id}', headers=headers, timeout=30)
+    response.raise_for_status()
+    return bool(response.json().get('mediaInfo'))
+
+
+def arr_item_exists(url, api_key):
+    """True if an *arr movie/series still exists (raises on API errors)"""
+    response = session.get(url, headers={'X-Api-Key': api_key}, timeout=30)
+    if response.status_code == 404:
+        return False
+    response.raise_for_status()
+    return True
+
+
+def remove_torrents_of(state, app, media_ids):
+    """Remove the torrents grabbed for these (deleted) Radarr/Sonarr media IDs"""
+    if app == 'radarr':
+        index = get_download_index(state, 'radarr', RADARR_URL, RADARR_API_KEY, 'movieId')
+    else:
+        index = get_download_index(state, 'sonarr', SONARR_URL, SONARR_API_KEY, 'seriesId')
+
+    remove_torrents_by_hash({app: index}, [
+        torrent_hash for torrent_hash, media_id in index.items() if media_id in media_ids
+    ])
+
+
+def handle_event(state, key):
+    """Targeted cleanup for one queued event; raises so the caller can retry"""
+    if key[0] == 'media':
+        _, media_type, tmdb_id, tvdb_id = key
+        # Notifications are only hints - act only if Jellyseerr really dropped it
+        if jellyseerr_tracks(media_type, tmdb_id):
+            log(f"  {media_type} {tmdb_id} is still tracked in Jellyseerr, nothing to do")
+            return
+
+        if media_type == 'movie':
+            movie = get_arr_items(f'{RADARR_URL}/api/v3/movie', RADARR_API_KEY, 'tmdbId',
+                                  params={'tmdbId': tmdb_id}).get(tmdb_id)
+            if movie:
+                deleted_ids = delete_movies_from_radarr([movie])
+                remove_torrents_of(state, 'radarr', deleted_ids)
+        elif tvdb_id:
+            series = get_arr_items(f'{SONARR_URL}/api/v3/series', SONARR_API_KEY, 'tvdbId',
+                                   params={'tvdbId': tvdb_id}).get(tvdb_id)
+            if series:
+                deleted_ids = delete_series_from_sonarr([series])
+                remove_torrents_of(state, 'sonarr', deleted_ids)
+        else:
+            log(f"  No TVDB ID for tv {tmdb_id}, leaving it to the next reconcile")
+
+    elif key[0] == 'radarr':
+        if not arr_item_exists(f'{RADARR_URL}/api/v3/movie/{key[1]}', RADARR_API_KEY):
+            remove_torrents_of(state, 'radarr', {key[1]})
+
+    elif key[0] == 'sonarr':
+        if not arr_item_exists(f'{SONARR_URL}/api/v3/series/{key[1]}', SONARR_API_KEY):
+            remove_torrents_of(state, 'sonarr', {key[1]})
+
+
+def serve():
+    """Long-running mode: handle webhook events as they arrive, reconcile periodically"""
+    lock = acquire_lock()
+    if lock is None:
+        log(f"ERROR: Another media cleanup holds {LOCK_FILE}")
+        sys.exit(1)
+
+    queue = EventQueue()
+    WebhookHandler.queue = queue
+    server = ThreadingHTTPServer(('', WEBHOOK_PORT), WebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log(f"Listening for webhooks on port {WEBHOOK_PORT} (reconcile every {RECONCILE_INTERVAL}s)")
+
+    state = load_state()
+    next_reconcile = time.monotonic()
+
+    while True:
+        if time.monotonic() >= next_reconcile:
+            log("Running full reconcile...")
+            metrics.start()
+            if reconcile(state):
+                next_reconcile = time.monotonic() + RECONCILE_INTERVAL
+                metrics.write()
+            else:
+                # Inventory incomplete - retry soon rather than a full interval later
+                next_reconcile = time.monotonic() + 300
+                metrics.write(success=False)
+
+        event = queue.get(timeout=max(next_reconcile - time.monotonic(), 0))
+        if event is None:
+            continue
+
+        key, attempt = event
+        log(f"Handling {key}")
+        metrics.start()
+        try:
+            handle_event(state, key)
+            save_state(state)
+            outcome = 'handled'
+        except Exception as e:
+            if attempt + 1 >= WEBHOOK_MAX_RETRIES:
+                log(f"  Error handling {key}: {e} - giving up, the next reconcile will catch it")
+                outcome = 'failed'
+            else:
+                delay = WEBHOOK_DELAY * 2 ** (attempt + 1)
+                log(f"  Error handling {key}: {e} - retrying in {delay}s")
+                queue.put(key, delay=delay, attempt=attempt + 1)
+                outcome = 'retried'
+
+        metrics.inc('homeserver_webhook_events_total', 'Queued webhook events processed, by outcome',
+                    type=key[0], outcome=outcome)
+        metrics.write(success=outcome != 'failed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove media from Radarr/Sonarr/qBittorrent that Jellyseerr no longer tracks')
+    parser.add_argument('--serve', action='store_true',
+                        help='run as a webhook receiver reacting to deletions')
+    args = parser.parse_args()
+
+    log("=" * 60)
+    log("Media Cleanup - Jellyseerr as Source of Truth")
+    log("=" * 60)
+
+    if DRY_RUN:
+        log("MODE: DRY RUN (no actual deletions)")
+    else:
+        log("MODE: LIVE (will delete orphaned media)")
+    metrics.set('homeserver_cleanup_dry_run', 'Whether deletions are only logged (1) or performed (0)', int(DRY_RUN))
+
+    if args.serve:
+        serve()
+        return
+
+    # The webhook receiver (or an overlapping cron run) already covers this
+    lock = acquire_lock()
+    if lock is None:
+        log("Another media cleanup is running (webhook receiver active?), skipping.")
+        return
+
+    state = load_state()
+    if not reconcile(state):
+        metrics.write(success=False)
+        sys.exit(1)
+    metrics.write()
 
     log("")
     log("Cleanup complete!")
@@ -4,10 +4,23 @@
 #
 # Environment variables provided by Radarr:
 # - radarr_eventtype: MovieDelete
+# - radarr_movie_id: Radarr movie ID
 # - radarr_movie_title: Movie title
 # - radarr_movie_path: Path to movie folder
+#
+# Torrents are resolved by exact hash: Radarr's grab history records the
+# torrent hash as downloadId. Radarr may purge the history before this hook
+# runs, so without history the torrents whose content_path or save_path lies
+# in the movie folder are used instead (one torrents/info call). If neither
+# finds anything, the torrent is left for media-cleanup.py, which resolves it
+# from its own hash index - but only removes it once DRY_RUN=false.
 
 QBITTORRENT_URL="${QBITTORRENT_URL:-http://qbittorrent:8080}"
+QBITTORRENT_USERNAME="${QBITTORRENT_USERNAME:-}"
+QBITTORRENT_PASSWORD="${QBITTORRENT_PASSWORD:-}"
+RADARR_URL="${RADARR_URL:-http://localhost:7878}"
+# Running inside the Radarr container, the API key can be read from its config
+RADARR_API_KEY="${RADARR_API_KEY:-$(sed -n 's:.*<ApiKey>\(.*\)</ApiKey>.*:\1:p' /config/config.xml 2>/dev/null)}"
 
 log() {
     echo "[$(date '+%Y-%m-%d %H:%M:%S')] $1"
@@ -22,32 +35,48 @@ fi
 log "Movie deleted: $radarr_movie_title"
 log "Path: $radarr_movie_path"
 
-# Extract just the movie name (without year) for more flexible matching
-# "Forrest Gump (1994)" -> "Forrest Gump"
-MOVIE_NAME=$(echo "$radarr_movie_title" | sed 's/ ([0-9]\{4\})$//')
-log "Looking for torrents matching: $MOVIE_NAME"
+# Look up the torrent hashes Radarr grabbed for this movie (eventType 1 = grabbed)
+HASHES=$(curl -s -H "X-Api-Key: ${RADARR_API_KEY}" \
+    "${RADARR_URL}/api/v3/history/movie?movieId=${radarr_movie_id}&eventType=1" 2>/dev/null \
+    | jq -r '[.[] | .downloadId // empty | ascii_downcase] | unique | join("|")' 2>/dev/null)
+
+# Log in once (if credentials are set) and reuse the SID cookie
+COOKIE_JAR=$(mktemp)
+trap 'rm -f "$COOKIE_JAR"' EXIT
 
-# Get all torrents from qBittorrent (as JSON)
-TORRENTS=$(curl -s "${QBITTORRENT_URL}/api/v2/torrents/info" 2>/dev/null)
+if [ -n "$QBITTORRENT_USERNAME" ]; then
+    LOGIN=$(curl -s -c "$COOKIE_JAR" -H "Referer: ${QBITTORRENT_URL}" \
+        --data-urlencode "username=${QBITTORRENT_USERNAME}" \
+        --data-urlencode "password=${QBITTORRENT_PASSWORD}" \
+        "${QBITTORRENT_URL}/api/v2/auth/login" 2>/dev/null)
+    if [ "$LOGIN" != "Ok." ]; then
+        log "qBittorrent login failed"
+        exit 1
+    fi
+fi
 
-if [ -z "$TORRENTS" ] || [ "$TORRENTS" = "[]" ]; then
-    log "No torrents found or failed to connect to qBittorrent"
+# History already purged - match torrents by path (both containers mount /data/media)
+if [ -z "$HASHES" ] && [ -n "$radarr_movie_path" ]; then
+    log "No download history for movie ${radarr_movie_id}, matching torrents by path"
+    HASHES=$(curl -s -b "$COOKIE_JAR" "${QBITTORRENT_URL}/api/v2/torrents/info" 2>/dev/null \
+        | jq -r --arg path "${radarr_movie_path%/}" \
+            '[.[] | select([.content_path, .save_path] | map(rtrimstr("/") // "")
+                | any(. == $path or startswith($path + "/")))
+              | .hash | ascii_downcase] | unique | join("|")' 2>/dev/null)
+fi
+
+if [ -z "$HASHES" ]; then
+    log "WARNING: No torrent found for movie ${radarr_movie_id} by history or path - left in qBittorrent"
+    log "WARNING: media-cleanup removes it on its next run only if its DRY_RUN=false"
     exit 0
 fi
 
-# Parse with jq and match by movie name
-echo "$TORRENTS" | jq -r '.[] | "\(.hash)|\(.name)"' | while IFS='|' read -r hash name; do
-    # Case-insensitive match on movie name
-    if echo "$name" | grep -iq "^${MOVIE_NAME}"; then
-        log "Found matching torrent: $name"
-        log "Hash: $hash"
+log "Hash(es): $HASHES"
 
-        # Delete torrent with files
-        RESULT=$(curl -s -X POST "${QBITTORRENT_URL}/api/v2/torrents/delete" \
-            -d "hashes=${hash}&deleteFiles=true" 2>/dev/null)
+# Delete all torrent(s) with files in a single pipe-joined call
+curl -s -b "$COOKIE_JAR" -X POST "${QBITTORRENT_URL}/api/v2/torrents/delete" \
+    --data-urlencode "hashes=${HASHES}" -d "deleteFiles=true" > /dev/null 2>&1
 
-        log "Deleted torrent and files"
-    fi
-done
+log "Deleted torrent(s) and files"
 
 log "Cleanup complete"
@@ -0,0 +1,70 @@
+"""
+Shared inventory snapshots for the maintenance scripts
+
+The cleanup jobs publish what they fetched to one SQLite file, so other jobs
+can reuse a recent-enough snapshot instead of asking the same service again.
+Only sources another job actually reads are published - currently the
+Jellyfin item set, which jellyseerr-cleanup uses to skip lookups.
+
+Snapshots are only ever an optimisation: a missing, stale or unreadable
+snapshot means "fetch it yourself", never "nothing there".
+"""
+
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+
+SNAPSHOT_DB = os.getenv('SNAPSHOT_DB', '/tmp/homeserver-snapshots.db')
+
+# Snapshots older than this many seconds are not reused by other jobs
+SNAPSHOT_MAX_AGE = int(os.getenv('SNAPSHOT_MAX_AGE', '900'))
+
+
+def connect():
+    db = sqlite3.connect(SNAPSHOT_DB, timeout=30)
+    # Readers never block the job that is writing a snapshot
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, fetched_at REAL NOT NULL)')
+    db.execute('CREATE TABLE IF NOT EXISTS items ('
+               'source TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+               'PRIMARY KEY (source, key))')
+    return db
+
+
+def load_snapshot(source, max_age=SNAPSHOT_MAX_AGE):
+    """Return {key: value} for source if it was written within max_age seconds, else None"""
+    try:
+        with closing(connect()) as db:
+            row = db.execute('SELECT fetched_at FROM sources WHERE source = ?', (source,)).fetchone()
+            if row is None or time.time() - row[0] > max_age:
+                return None
+            return {
+                key: json.loads(value)
+                for key, value in db.execute('SELECT key, value FROM items WHERE source = ?', (source,))
+            }
+    except (sqlite3.Error, ValueError) as e:
+        print(f"WARNING: Could not read snapshot {source} from {SNAPSHOT_DB}: {e}")
+        return None
+
+
+def save_snapshot(source, items, fetched_at=None):
+    """
+    Replace the snapshot of source with items ({key: JSON-serialisable value})
+    in one transaction. Returns False if it could not be saved.
+    """
+    try:
+        with closing(connect()) as db, db:
+            db.execute('DELETE FROM items WHERE source = ?', (source,))
+            db.executemany('INSERT INTO items (source, key, value) VALUES (?, ?, ?)',
+                           [(source, str(key), json.dumps(value, sort_keys=True))
+                            for key, value in items.items()])
+            db.execute('INSERT OR REPLACE INTO sources (source, fetched_at) VALUES (?, ?)',
+                       (source, fetched_at or time.time()))
+    except sqlite3.Error as e:
+        # Not fatal - other jobs simply fetch this source themselves
+        print(f"WARNING: Could not write snapshot {source} to {SNAPSHOT_DB}: {e}")
+        return False
+
+    return True
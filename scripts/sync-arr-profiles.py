@@ -2,12 +2,25 @@
 """
 Sync Custom Formats from Radarr to Sonarr
 This script copies custom formats (like H.264 preference) from Radarr to Sonarr
+
+Formats are matched by name and compared by a fingerprint of their
+specifications, so changed formats are updated and unchanged ones left alone.
+Radarr and Sonarr do not share every specification type or enum value, so
+formats are translated for Sonarr first; formats using anything without a
+Sonarr equivalent (editions, quality modifiers, CAM sources, ...) are skipped.
+The fingerprint of Radarr's whole set is kept between runs: if Radarr has not
+changed, the run stops after one request (a full compare still runs every
+SYNC_FULL_INTERVAL seconds to catch edits made in Sonarr).
 """
 
 import requests
+import hashlib
 import json
 import os
 import sys
+import time
+import job_metrics
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration from environment variables
 RADARR_URL = os.getenv("RADARR_URL", "http://radarr:7878")
@@ -15,6 +28,26 @@ RADARR_API_KEY = os.getenv("RADARR_API_KEY", "")
 SONARR_URL = os.getenv("SONARR_URL", "http://sonarr:8989")
 SONARR_API_KEY = os.getenv("SONARR_API_KEY", "")
 
+# Creates/updates are sent to Sonarr on this many parallel requests
+SYNC_CONCURRENCY = int(os.getenv("SYNC_ARR_PROFILES_CONCURRENCY", "4"))
+REQUEST_TIMEOUT = int(os.getenv("SYNC_ARR_PROFILES_TIMEOUT", "30"))
+
+# Radarr fingerprint of the last successful sync
+STATE_FILE = os.getenv("SYNC_ARR_PROFILES_STATE_FILE", "/tmp/sync-arr-profiles-state.json")
+SYNC_FULL_INTERVAL = int(os.getenv("SYNC_ARR_PROFILES_FULL_INTERVAL", "86400"))
+
+# Specification types that mean the same in Radarr and Sonarr, with the fields
+# whose enum values differ: {implementation: {field name: {Radarr value: Sonarr value}}}
+# Radarr sources: 5 DVD, 6 TV, 7 WEBDL, 8 WEBRIP, 9 BLURAY (0-4 are unknown/CAM/...)
+# Sonarr sources: 1 Television, 3 Web, 4 WebRip, 5 DVD, 6 Bluray
+PORTABLE_SPECIFICATIONS = {
+    "ReleaseTitleSpecification": {},
+    "ReleaseGroupSpecification": {},
+    "ResolutionSpecification": {},
+    "SizeSpecification": {},
+    "SourceSpecification": {"value": {5: 5, 6: 1, 7: 3, 8: 4, 9: 6}},
+}
+
 # Check if API keys are set
 if not RADARR_API_KEY or not SONARR_API_KEY:
     print("ERROR: API keys not set")
@@ -26,78 +59,253 @@ if not RADARR_API_KEY or not SONARR_API_KEY:
     print("  - Sonarr: Settings → General → Security → API Key")
     sys.exit(1)
 
+# Run outcome, format counts and request latency/errors for the Prometheus textfile collector
+metrics = job_metrics.JobMetrics("sync-arr-profiles")
+
+# Keep-alive sessions shared by all requests (and the worker pool)
+radarr = metrics.instrument(requests.Session())
+radarr.headers["X-Api-Key"] = RADARR_API_KEY
+sonarr = metrics.instrument(requests.Session())
+sonarr.headers["X-Api-Key"] = SONARR_API_KEY
+sonarr.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=SYNC_CONCURRENCY))
+sonarr.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=SYNC_CONCURRENCY))
+
 def get_radarr_custom_formats():
     """Get all custom formats from Radarr"""
-    response = requests.get(
-        f"{RADARR_URL}/api/v3/customformat",
-        headers={"X-Api-Key": RADARR_API_KEY}
-    )
+    response = radarr.get(f"{RADARR_URL}/api/v3/customformat", timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
     return response.json()
 
 def get_sonarr_custom_formats():
     """Get all custom formats from Sonarr"""
-    response = requests.get(
-        f"{SONARR_URL}/api/v3/customformat",
-        headers={"X-Api-Key": SONARR_API_KEY}
-    )
+    response = sonarr.get(f"{SONARR_URL}/api/v3/customformat", timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
     return response.json()
 
 def create_sonarr_custom_format(custom_format):
     """Create a custom format in Sonarr"""
-    # Remove ID and includeCustomFormatWhenRenaming (not compatible)
+    # Remove ID - Sonarr assigns its own
     cf_data = custom_format.copy()
     if 'id' in cf_data:
         del cf_data['id']
 
-    response = requests.post(
+    response = sonarr.post(
         f"{SONARR_URL}/api/v3/customformat",
-        headers={"X-Api-Key": SONARR_API_KEY},
-        json=cf_data
+        json=cf_data,
+        timeout=REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+def update_sonarr_custom_format(sonarr_id, custom_format):
+    """Replace an existing Sonarr custom format with Radarr's definition"""
+    cf_data = dict(custom_format, id=sonarr_id)
+
+    response = sonarr.put(
+        f"{SONARR_URL}/api/v3/customformat/{sonarr_id}",
+        json=cf_data,
+        timeout=REQUEST_TIMEOUT
     )
     response.raise_for_status()
     return response.json()
 
+def to_sonarr_format(custom_format):
+    """
+    Radarr custom format with its specifications translated for Sonarr, or None
+    if any specification (or enum value) has no Sonarr equivalent
+    """
+    specifications = []
+    for spec in custom_format.get("specifications", []):
+        translations = PORTABLE_SPECIFICATIONS.get(spec.get("implementation"))
+        if translations is None:
+            return None
+
+        fields = []
+        for field in spec.get("fields", []):
+            mapping = translations.get(field.get("name"))
+            if mapping is not None:
+                if field.get("value") not in mapping:
+                    return None
+                field = dict(field, value=mapping[field["value"]])
+            fields.append(field)
+        specifications.append(dict(spec, fields=fields))
+
+    return dict(custom_format, specifications=specifications)
+
+def format_fingerprint(custom_format):
+    """
+    Hash of what a custom format matches. Only setting values count - field
+    labels, help texts and IDs differ between Radarr and Sonarr - and
+    specifications are sorted so their order does not matter.
+    """
+    specifications = sorted(
+        (
+            {
+                "name": spec.get("name"),
+                "implementation": spec.get("implementation"),
+                "negate": spec.get("negate", False),
+                "required": spec.get("required", False),
+                "fields": {field.get("name"): field.get("value") for field in spec.get("fields", [])},
+            }
+            for spec in custom_format.get("specifications", [])
+        ),
+        key=lambda spec: json.dumps(spec, sort_keys=True)
+    )
+    canonical = {
+        "name": custom_format.get("name"),
+        "includeCustomFormatWhenRenaming": custom_format.get("includeCustomFormatWhenRenaming", False),
+        "specifications": specifications,
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+def set_fingerprint(fingerprints):
+    """Hash of a whole set of formats ({name: fingerprint})"""
+    return hashlib.sha256(json.dumps(fingerprints, sort_keys=True).encode()).hexdigest()
+
+def load_state():
+    """Load the last sync state, or None if there is none"""
+    try:
+        with open(STATE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_state(state):
+    """Atomically write the sync state"""
+    tmp_file = f"{STATE_FILE}.tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, STATE_FILE)
+    except OSError as e:
+        print(f"WARNING: Could not save state to {STATE_FILE}: {e}")
+
+def plan_sync(radarr_formats, sonarr_formats):
+    """
+    Compare both sides by name and fingerprint.
+    Returns (to_create, to_update, unchanged): to_create is a list of (translated) Radarr
+    formats, to_update a list of (Sonarr ID, Radarr format), unchanged a list of names.
+    """
+    sonarr_by_name = {cf["name"]: cf for cf in sonarr_formats}
+    to_create = []
+    to_update = []
+    unchanged = []
+
+    for radarr_cf in radarr_formats:
+        sonarr_cf = sonarr_by_name.get(radarr_cf["name"])
+        if sonarr_cf is None:
+            to_create.append(radarr_cf)
+        elif format_fingerprint(sonarr_cf) != format_fingerprint(radarr_cf):
+            to_update.append((sonarr_cf["id"], radarr_cf))
+        else:
+            unchanged.append(radarr_cf["name"])
+
+    return to_create, to_update, unchanged
+
+def apply_sync(to_create, to_update):
+    """Send creates and updates to Sonarr concurrently; returns (created, updated, failed) counts"""
+    created_count = 0
+    updated_count = 0
+    failed_count = 0
+
+    with ThreadPoolExecutor(max_workers=SYNC_CONCURRENCY) as executor:
+        creates = [(cf, executor.submit(create_sonarr_custom_format, cf)) for cf in to_create]
+        updates = [(cf, executor.submit(update_sonarr_custom_format, sonarr_id, cf))
+                   for sonarr_id, cf in to_update]
+
+        for cf, future in creates:
+            try:
+                future.result()
+                print(f"  ✓ Created '{cf['name']}' in Sonarr")
+                created_count += 1
+            except Exception as e:
+                print(f"  ✗ Failed to create '{cf['name']}': {e}")
+                failed_count += 1
+
+        for cf, future in updates:
+            try:
+                future.result()
+                print(f"  ✓ Updated '{cf['name']}' in Sonarr")
+                updated_count += 1
+            except Exception as e:
+                print(f"  ✗ Failed to update '{cf['name']}': {e}")
+                failed_count += 1
+
+    return created_count, updated_count, failed_count
+
+def report_counts(created, updated, unchanged, failed, skipped):
+    """Custom formats by sync outcome, for the textfile collector"""
+    for outcome, count in (("created", created), ("updated", updated),
+                           ("unchanged", unchanged), ("failed", failed), ("skipped", skipped)):
+        metrics.set("homeserver_custom_formats", "Custom formats by outcome of the last sync",
+                    count, outcome=outcome)
+
 def main():
     print("=== Syncing Custom Formats from Radarr to Sonarr ===\n")
 
-    # Get custom formats from both
+    # Get custom formats from Radarr first - it is all we need if nothing changed
     print("Fetching Radarr custom formats...")
     radarr_formats = get_radarr_custom_formats()
     print(f"Found {len(radarr_formats)} custom formats in Radarr")
 
+    # Formats Sonarr cannot express are skipped, not failed - they would never
+    # succeed, and a failure keeps the state from being saved
+    sonarr_versions = []
+    skipped = []
+    for cf in radarr_formats:
+        translated = to_sonarr_format(cf)
+        if translated is None:
+            skipped.append(cf["name"])
+        else:
+            sonarr_versions.append(translated)
+    if skipped:
+        print(f"Skipping {len(skipped)} format(s) with no Sonarr equivalent: {', '.join(skipped)}")
+
+    radarr_fingerprint = set_fingerprint({cf["name"]: format_fingerprint(cf) for cf in radarr_formats})
+    state = load_state()
+    now = time.time()
+    if (state and state.get("radarr_fingerprint") == radarr_fingerprint
+            and now - state.get("full_sync_at", 0) < SYNC_FULL_INTERVAL):
+        print("\nRadarr custom formats unchanged since the last sync, nothing to do.")
+        report_counts(0, 0, len(sonarr_versions), 0, len(skipped))
+        return True
+
     print("\nFetching Sonarr custom formats...")
     sonarr_formats = get_sonarr_custom_formats()
-    sonarr_format_names = {cf['name'] for cf in sonarr_formats}
     print(f"Found {len(sonarr_formats)} custom formats in Sonarr")
 
+    to_create, to_update, unchanged = plan_sync(sonarr_versions, sonarr_formats)
+    print(f"\n{len(to_create)} to create, {len(to_update)} to update, {len(unchanged)} unchanged")
+
     # Sync formats
     print("\nSyncing custom formats...\n")
-    created_count = 0
-    skipped_count = 0
+    created_count, updated_count, failed_count = apply_sync(to_create, to_update)
 
-    for radarr_cf in radarr_formats:
-        name = radarr_cf['name']
+    report_counts(created_count, updated_count, len(unchanged), failed_count, len(skipped))
 
-        if name in sonarr_format_names:
-            print(f"  ⊘ Skipping '{name}' (already exists in Sonarr)")
-            skipped_count += 1
-            continue
-
-        try:
-            create_sonarr_custom_format(radarr_cf)
-            print(f"  ✓ Created '{name}' in Sonarr")
-            created_count += 1
-        except Exception as e:
-            print(f"  ✗ Failed to create '{name}': {e}")
+    # Only a clean sync is remembered - failures are retried on the next run
+    if not failed_count:
+        save_state({"radarr_fingerprint": radarr_fingerprint, "full_sync_at": now})
 
     print(f"\n=== Sync Complete ===")
     print(f"Created: {created_count}")
-    print(f"Skipped: {skipped_count}")
-    print(f"\nNote: You still need to manually configure the scores in:")
-    print(f"  Sonarr → Settings → Profiles → Edit your quality profile")
-    print(f"  Then assign scores to the custom formats that were just created.")
+    print(f"Updated: {updated_count}")
+    print(f"Unchanged: {len(unchanged)}")
+    if skipped:
+        print(f"Skipped: {len(skipped)}")
+    if failed_count:
+        print(f"Failed: {failed_count}")
+    if created_count:
+        print(f"\nNote: You still need to manually configure the scores in:")
+        print(f"  Sonarr → Settings → Profiles → Edit your quality profile")
+        print(f"  Then assign scores to the custom formats that were just created.")
+
+    return not failed_count
 
 if __name__ == '__main__':
-    main()
+    try:
+        success = main()
+    except Exception:
+        metrics.write(success=False)
+        raise
+    metrics.write(success=success)
@@ -8,6 +8,8 @@ echo ""
 
 docker run --rm \
     --network internal \
-    -v /opt/homeserver/scripts/sync-arr-profiles.py:/app/sync.py:ro \
+    -v /opt/homeserver/scripts:/app:ro \
+    -e RADARR_API_KEY="$RADARR_API_KEY" \
+    -e SONARR_API_KEY="$SONARR_API_KEY" \
     python:3.11-slim \
-    bash -c "pip install -q requests && python3 /app/sync.py"
+    bash -c "pip install -q requests && python3 /app/sync-arr-profiles.py"
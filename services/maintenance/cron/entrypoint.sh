@@ -10,7 +10,7 @@ echo ""
 
 # Install dependencies
 echo "Installing dependencies..."
-apk add --no-cache python3 py3-pip curl docker-cli tzdata > /dev/null 2>&1
+apk add --no-cache python3 py3-pip py3-yaml curl docker-cli tzdata > /dev/null 2>&1
 cp /usr/share/zoneinfo/Europe/Madrid /etc/localtime
 echo 'Europe/Madrid' > /etc/timezone
 pip3 install --break-system-packages requests > /dev/null 2>&1
@@ -37,6 +37,20 @@ echo ""
 # Create log file
 touch /var/log/cron.log
 
+# Start the Jellyfin cleanup watcher (reacts to deletions under /data/media).
+# While it runs, the per-minute cron job detects its lock and skips itself.
+if [ "${JELLYFIN_WATCH:-false}" = "true" ]; then
+    echo "Starting Jellyfin cleanup watcher..."
+    python3 /scripts/jellyfin-cleanup.py --watch >> /var/log/cron.log 2>&1 &
+fi
+
+# Start the media cleanup webhook receiver (Jellyseerr/Radarr/Sonarr notify it
+# on deletions). While it runs, the 15-minute cron job skips itself.
+if [ "${MEDIA_CLEANUP_WEBHOOK:-false}" = "true" ]; then
+    echo "Starting media cleanup webhook receiver..."
+    python3 /scripts/media-cleanup.py --serve >> /var/log/cron.log 2>&1 &
+fi
+
 # Start cron in background and tail the log file
 crond -f -l 2 &
 